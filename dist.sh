@@ -5,5 +5,5 @@ DIST=pyweek-lightswitch-$VERSION
 
 rm -rf $DIST || true
 mkdir $DIST
-cp -r *.ttf run_game.py picture_render.py README.md pictures_vbuf.zip sounds $DIST
+cp -r *.ttf run_game.py gl_state.py picture_render.py picture_pack.py line_buffers.py word_index.py README.md pictures.pack sounds $DIST
 COPYFILE_DISABLE=1 zip -r $DIST.zip $DIST
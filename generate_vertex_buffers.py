@@ -1,17 +1,67 @@
+import argparse
+import copy
 import ctypes
+import itertools
+import json
+import multiprocessing
+import os
+import sys
 import zipfile
 
+import line_buffers
+import picture_pack
+import picture_stream
+
+try:
+  import numpy
+  import picture_validate
+  import stroke_mesh
+  import stroke_simplify
+except ImportError:
+  numpy = None
+
 # The full pictures.py was too large to comfortably parse on my
-# system, so I manually split it into smaller parts and ran this
-# program repeatedly.
+# system, so it used to be split into smaller parts by hand, and this
+# program was run once per part. Now the sources are streamed one word
+# at a time (see picture_stream.py), so they can all go in one run:
+#
+#   python generate_vertex_buffers.py pictures_missing*.py
+#
+# The drawer's pictures.js and pictures.json files can be given too,
+# so a new batch of drawings can go straight into the pack:
 #
-# (Also, gore-tex is broken, so remove that one, and throw in 'NaN =
-# None' at the top of every file to deal with some broken values.)
-import pictures_missing_4 as pictures
+#   python generate_vertex_buffers.py pictures_missing*.py pictures.json
+#
+# The words are converted in parallel, but written in sorted order, so
+# the output is the same no matter how many processes were used. Only
+# the words whose source changed since the last build are converted
+# again (see Build).
+#
+# Broken values like NaN are read as None, and every picture goes
+# through picture_validate.py before it is encoded. It repairs what it
+# can, and the pictures it rejects are left out of the output.
+SOURCES = [
+  'pictures_missing.py',
+  'pictures_missing_2.py',
+  'pictures_missing_3.py',
+  'pictures_missing_4.py',
+]
+
+# The output format depends on the extension: .pack (see
+# picture_pack.py) or .zip.
+OUTPUT = 'pictures.pack'
+
+# Fixed timestamp for the zip entries, so that builds are reproducible.
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
 
-all_the_words = pictures.words
+# The manifest next to the output lists the SHA-1 of the source of
+# every word in it. Bump the version when the encoding changes, to
+# force a full rebuild.
+MANIFEST_VERSION = 4
 
-OUTPUT = 'pictures_vbuf.zip'
+# The lines are at most 2 pixels wide on an 800 pixel wide screen, so
+# the pressure can be 100/1000 off for half a pixel of width.
+LOD_PRESSURE_TOLERANCE = 100
 
 
 def GenerateVertexBuffer(data):
@@ -62,12 +112,471 @@ def GenerateVertexBuffer(data):
   return v_array
 
 
+# Returns the number of points of each stroke that GenerateVertexArray
+# keeps. The empty strokes are skipped, and so are the points at the
+# end of a stroke that have no time.
+def StrokeLengths(data):
+  lengths = []
+  for stroke in data:
+    if not stroke:
+      continue
+    n = len(stroke)
+    while stroke[n - 1].time == None:
+      n -= 1
+    lengths.append(n)
+  return lengths
+
+
+# Same as GenerateVertexBuffer, but works on whole arrays instead of
+# point by point. Returns a float32 array of shape (N, 4). The
+# arithmetic is done in the same order and precision as above, so the
+# result is the same down to the last bit.
+def GenerateVertexArray(data):
+  lengths = StrokeLengths(data)
+  points = []
+  for stroke, n in zip([stroke for stroke in data if stroke], lengths):
+    points.extend(stroke[:n])
+  # Columns: time, x, y, pressure.
+  points = numpy.fromiter(itertools.chain.from_iterable(points),
+                          numpy.float64, 4 * len(points)).reshape(-1, 4)
+  lengths = numpy.array(lengths)
+  ends = numpy.cumsum(lengths)
+  starts = ends - lengths
+  last_t = points[ends - 1, 0]
+  t_adjust = numpy.cumsum(points[starts, 0] - numpy.append(0, last_t[:-1]))
+
+  # Each stroke gets an extra zero-pressure vertex at both ends.
+  first = starts + 2 * numpy.arange(len(lengths))
+  last = first + lengths + 1
+  vertices = numpy.empty((len(points) + 2 * len(lengths), 4))
+  index = numpy.arange(len(points)) + 1 + numpy.repeat(first - starts, lengths)
+  vertices[index, 0] = points[:, 1]
+  vertices[index, 1] = points[:, 2]
+  vertices[index, 2] = points[:, 0] - numpy.repeat(t_adjust, lengths)
+  vertices[index, 3] = numpy.minimum(1, points[:, 3] / 500.)
+  vertices[first] = vertices[first + 1]
+  vertices[last] = vertices[last - 1]
+  vertices[first, 3] = 0
+  vertices[last, 3] = 0
+  max_t = vertices[-1, 2]
+
+  min_x = points[:, 1].min()
+  max_x = points[:, 1].max()
+  min_y = points[:, 2].min()
+  max_y = points[:, 2].max()
+  x_scale = 1 / float(max_x - min_x)
+  y_scale = 1 / float(max_y - min_y)
+  scale = min(x_scale, y_scale)
+  if x_scale > y_scale:
+    x_offs = (1 - y_scale / x_scale) / 2.
+    y_offs = 0
+  else:
+    x_offs = 0
+    y_offs = (1 - x_scale / y_scale) / 2.
+  t_scale = 1 / float(max_t)
+  vertices[:, 0] = 0.05 + 0.9 * ((vertices[:, 0] - min_x) * scale + x_offs)
+  vertices[:, 1] = 0.95 - 0.9 * ((vertices[:, 1] - min_y) * scale + y_offs)
+  vertices[:, 2] = vertices[:, 2] * t_scale
+  return vertices.astype(numpy.float32)
+
+
+# Returns (kind, payload) for a picture, where the payload is a string
+# ready to be stored and the kind is one of the picture_pack.KIND_*
+# constants. Uses the NumPy version if NumPy is available.
+#
+# Options:
+#   lines: Store the expanded lines that WordPicture draws, instead of
+#          the points. (Only for packs.)
+#   simplify: Drop the points that are within this many pixels of the
+#             simplified strokes (see stroke_simplify.py).
+#   compact: Store the compact points (see line_buffers.py). Needs
+#            NumPy. (Only for packs.)
+#   delta: Delta-code the compact points.
+#   mesh: Store the strokes tessellated into a triangle strip (see
+#         stroke_mesh.py). Needs NumPy. (Only for packs.)
+#
+# If a report dict is given, the simplification stats are put in it.
+def EncodePicture(data, options={}, report=None):
+  if options.get('simplify'):
+    data, stats = stroke_simplify.SimplifyPicture(data, options['simplify'])
+    if report is not None:
+      report['points'], report['kept'], report['deviation'] = stats
+  if options.get('mesh'):
+    mesh = stroke_mesh.TessellatePicture(GenerateVertexArray(data),
+                                         StrokeLengths(data))
+    return picture_pack.KIND_MESH, mesh.tostring()
+  if options.get('compact'):
+    compact = line_buffers.QuantizePoints(GenerateVertexArray(data))
+    if options.get('delta'):
+      return picture_pack.KIND_COMPACT_DELTA, line_buffers.DeltaEncode(compact)
+    return picture_pack.KIND_COMPACT, compact
+  if numpy is not None:
+    points = GenerateVertexArray(data)
+    points = (ctypes.c_float * points.size).from_buffer(points)
+  else:
+    points = GenerateVertexBuffer(data)
+  if options.get('lines'):
+    return picture_pack.KIND_LINES, line_buffers.PackLines(points)
+  return picture_pack.KIND_POINTS, buffer(points)[:]
+
+
+# Returns a list of (kind, payload) pairs, one for each level of
+# detail. Level 0 is the picture encoded by EncodePicture. With the lod
+# option, up to that many simpler levels follow, each simplified to
+# half a pixel at its picture_pack.LEVEL_SIZES size. The time tolerance
+# grows with the distance tolerance, so the tip of the animation is
+# about as accurate as the lines. A level is only added if it drops
+# some more points. Needs NumPy for the levels.
+def EncodeLevels(data, options={}, report=None):
+  if report is None:
+    report = {}
+  levels = [EncodePicture(data, options, report)]
+  lod = min(options.get('lod', 0), len(picture_pack.LEVEL_SIZES) - 1)
+  if not lod:
+    return levels
+  # The picture is scaled so that its larger side is 90% of the
+  # square, so this many source pixels make one screen pixel at size 1.
+  points = [p for stroke in data for p in stroke if p.time is not None]
+  extent = max(max(p.x for p in points) - min(p.x for p in points),
+               max(p.y for p in points) - min(p.y for p in points)) / 0.9
+  level_options = dict(options)
+  level_options.pop('simplify', None)
+  # Level 0 has all the points, or the ones the simplify option kept.
+  last = report.get('kept', sum(StrokeLengths(data)))
+  kept = []
+  for size in picture_pack.LEVEL_SIZES[1:lod + 1]:
+    epsilon = max(0.5 * extent / size, options.get('simplify', 0))
+    simple, (_, count, _) = stroke_simplify.SimplifyPicture(
+        data, epsilon, LOD_PRESSURE_TOLERANCE,
+        stroke_simplify.TIME_TOLERANCE * epsilon / stroke_simplify.EPSILON)
+    if count == last:
+      break
+    levels.append(EncodePicture(simple, level_options))
+    kept.append(count)
+    last = count
+  report['levels'] = kept
+  return levels
+
+
+# Checks that the NumPy version gives exactly the same bytes as the
+# original loop for every word that passes validation, like in the
+# build.
+def Check(sources):
+  mismatches = 0
+  for source in sources:
+    for word, data in picture_stream.ReadWords(source):
+      data, problems = picture_validate.ValidatePicture(data)
+      if data is None:
+        continue
+      fast = GenerateVertexArray(data).tostring()
+      slow = buffer(GenerateVertexBuffer(copy.deepcopy(data)))[:]
+      if fast != slow:
+        print 'Mismatch:', word
+        mismatches += 1
+  return mismatches
+
+
+# Finds all the words in the sources. If a word appears more than
+# once, the last one wins, like in a dict literal. Returns a list of
+# (word, source, offset, digest) sorted by word.
+def FindWords(sources):
+  found = {}
+  for source in sources:
+    for word, offset, digest in picture_stream.ScanWords(source):
+      found[word] = source, offset, digest
+  return sorted((word, source, offset, digest)
+                for word, (source, offset, digest) in found.iteritems())
+
+
+# Without NumPy the pictures cannot be validated, but the ones that
+# GenerateVertexBuffer cannot scale are still rejected, with the same
+# names as in picture_validate.py. Returns the problem, or None.
+def _Degenerate(data):
+  strokes = [[p for p in stroke if p.time is not None] for stroke in data]
+  strokes = [stroke for stroke in strokes if stroke]
+  if not strokes:
+    return 'empty'
+  points = [p for stroke in strokes for p in stroke]
+  if (min(p.x for p in points) == max(p.x for p in points) or
+      min(p.y for p in points) == max(p.y for p in points)):
+    return 'zero-area'
+  if not sum(stroke[-1].time - stroke[0].time for stroke in strokes):
+    return 'zero-duration'
+  return None
+
+
+def _EncodeWordAt(args):
+  job, options = args
+  word, source, offset, digest = job
+  read_word, data = picture_stream.ReadWordAt(source, offset)
+  assert read_word == word, (word, read_word)
+  report = {}
+  if numpy is not None:
+    data, report['problems'] = picture_validate.ValidatePicture(data)
+    if data is None:
+      return word, None, report
+  else:
+    problem = _Degenerate(data)
+    if problem:
+      report['problems'] = [{'problem': problem, 'action': 'rejected'}]
+      return word, None, report
+  return word, EncodeLevels(data, options, report), report
+
+
+# Parses and encodes the words on a pool of processes. Yields (word,
+# levels, report) tuples, where levels is from EncodeLevels, or None if
+# the picture was rejected, in the same order as the jobs, no
+# matter how many processes are used.
+def EncodeWords(jobs, options, processes=None):
+  jobs = itertools.izip(jobs, itertools.repeat(options))
+  if processes == 1:
+    for result in itertools.imap(_EncodeWordAt, jobs):
+      yield result
+    return
+  pool = multiprocessing.Pool(processes)
+  try:
+    for result in pool.imap(_EncodeWordAt, jobs, chunksize=4):
+      yield result
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+
+
+class ZipWriter(object):
+  def __init__(self, path):
+    self.zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+
+  def Add(self, word, vbuf, kind=picture_pack.KIND_POINTS, level=0):
+    if kind != picture_pack.KIND_POINTS or level != 0:
+      raise ValueError('Zip files can only hold points, without levels.')
+    info = zipfile.ZipInfo(word, ZIP_DATE_TIME)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0644 << 16
+    self.zip.writestr(info, vbuf)
+
+  def Close(self):
+    self.zip.close()
+
+
+def OpenOutput(path):
+  if path.endswith('.pack'):
+    return picture_pack.PackWriter(path)
+  return ZipWriter(path)
+
+
+# An earlier output, to copy unchanged words from.
+class OldOutput(object):
+  def __init__(self, path):
+    if path.endswith('.pack'):
+      self.pack = picture_pack.Pack(path)
+      self.words = self.pack.words
+    else:
+      self.zip = zipfile.ZipFile(path)
+      self.words = self.zip.namelist()
+
+  # Returns a list of (kind, payload) pairs, one for each level.
+  def Read(self, word):
+    if hasattr(self, 'pack'):
+      return [(kind, buffer(payload)[:])
+              for kind, payload in self.pack.Read(word)]
+    return [(picture_pack.KIND_POINTS, self.zip.read(word))]
+
+  def Close(self):
+    if hasattr(self, 'pack'):
+      self.pack.Close()
+    else:
+      self.zip.close()
+
+
+def ManifestPath(output_path):
+  return output_path + '.manifest'
+
+
+# Returns the {word: digest} dict of the last build and the set of
+# words it rejected, or an empty dict and set if it cannot be used.
+def LoadManifest(output_path, options):
+  if not os.path.exists(output_path):
+    return {}, set()
+  try:
+    with open(ManifestPath(output_path)) as f:
+      manifest = json.load(f)
+  except (IOError, ValueError):
+    return {}, set()
+  if (manifest.get('version') != MANIFEST_VERSION or
+      manifest.get('options') != options):
+    return {}, set()
+  return manifest['words'], set(manifest['rejected'])
+
+
+def SaveManifest(output_path, options, jobs, rejected):
+  manifest = {
+    'version': MANIFEST_VERSION,
+    'options': options,
+    'words': dict((word, digest) for word, source, offset, digest in jobs),
+    'rejected': sorted(rejected),
+  }
+  with open(ManifestPath(output_path), 'w') as f:
+    json.dump(manifest, f, indent=0, sort_keys=True)
+
+
+# Writes the vertex buffers for all the words in the sources. Words
+# whose source is unchanged since the last build are copied from the
+# old output, the rest are encoded again. The output is always written
+# from scratch, so every word has exactly one entry, and it is the same
+# as what a full build would give. Rejected words are left out of the
+# output, and only encoded again when their source changes. See
+# EncodePicture for the options.
+# If a report path is given, the validation problems of the encoded
+# words are written there as JSON, like from picture_validate.py.
+def Build(sources, output_path, options={}, processes=None, incremental=True,
+          report_path=None):
+  jobs = FindWords(sources)
+  manifest, old_rejected = (
+      LoadManifest(output_path, options) if incremental else ({}, set()))
+  old = OldOutput(output_path) if manifest else None
+  old_words = set(old.words) if old else set()
+  changed = [job for job in jobs
+             if manifest.get(job[0]) != job[3] or
+             job[0] not in old_words and job[0] not in old_rejected]
+  if old and not changed and len(manifest) == len(jobs) and (
+      len(old_words) == len(old.words) == len(jobs) - len(old_rejected)):
+    print 'Up to date.'
+    return
+  if len(changed) < 8:
+    # Not worth starting the pool.
+    processes = 1
+  encoded = EncodeWords(changed, options, processes)
+  changed = set(job[0] for job in changed)
+
+  base, extension = os.path.splitext(output_path)
+  temp_path = base + '.tmp' + extension
+  output = OpenOutput(temp_path)
+  points = kept = 0
+  rejected = set()
+  validation = {}
+  counts = dict.fromkeys(['ok', 'repaired', 'rejected'], 0)
+  for word, source, offset, digest in jobs:
+    if word in changed:
+      encoded_word, levels, report = next(encoded)
+      assert encoded_word == word, (word, encoded_word)
+      problems = report.get('problems', [])
+      if numpy is not None:
+        status = picture_validate.Status(problems)
+      else:
+        status = 'ok' if levels is not None else 'rejected'
+      counts[status] += 1
+      if problems:
+        validation[word] = {'source': source, 'status': status,
+                            'problems': problems}
+      if levels is None:
+        print '%-20s rejected: %s' % (word, problems[-1]['problem'])
+        rejected.add(word)
+        continue
+      line = word
+      if 'points' in report:
+        line = '%-20s %6d -> %6d points (%3d%%), max deviation %.2fpx' % (
+            word, report['points'], report['kept'],
+            100 * report['kept'] / max(1, report['points']),
+            report['deviation'])
+        points += report['points']
+        kept += report['kept']
+      if report.get('levels'):
+        line = '%-20s levels: %s' % (
+            line, ' '.join(str(count) for count in report['levels']))
+      if problems:
+        line = '%-20s repaired: %s' % (line, ', '.join(
+            sorted(set(problem['problem'] for problem in problems))))
+      print line
+    elif word in old_rejected:
+      rejected.add(word)
+      continue
+    else:
+      levels = old.Read(word)
+    for level, (kind, payload) in enumerate(levels):
+      output.Add(word, payload, kind, level)
+  output.Close()
+  if old:
+    old.Close()
+  if os.path.exists(output_path):
+    os.remove(output_path)
+  os.rename(temp_path, output_path)
+  SaveManifest(output_path, options, jobs, rejected)
+  if report_path:
+    with open(report_path, 'w') as f:
+      json.dump({'summary': counts, 'words': validation}, f,
+                indent=1, sort_keys=True)
+  print '%d of %d pictures encoded.' % (len(changed), len(jobs))
+  if numpy is None:
+    print 'NumPy is not available, so the pictures were not fully validated.'
+  if counts['repaired'] or counts['rejected']:
+    print '%d pictures repaired, %d rejected.' % (
+        counts['repaired'], counts['rejected'])
+  if points:
+    print 'Simplified %d points to %d (%d%%).' % (
+        points, kept, 100 * kept / points)
+
 
-output = zipfile.ZipFile(OUTPUT, 'a', zipfile.ZIP_DEFLATED)
+def main(argv):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('sources', nargs='*', default=SOURCES)
+  parser.add_argument('-o', '--output', default=OUTPUT)
+  parser.add_argument('-j', '--jobs', type=int, default=None,
+                      help='number of processes (default: all cores)')
+  parser.add_argument('--full', action='store_true',
+                      help='encode every word, even if it did not change')
+  parser.add_argument('--lines', action='store_true',
+                      help='store the expanded lines instead of the points')
+  parser.add_argument('--compact', action='store_true',
+                      help='store 8-byte quantized points')
+  parser.add_argument('--delta', action='store_true',
+                      help='delta-code the compact points')
+  parser.add_argument('--mesh', action='store_true',
+                      help='store the strokes tessellated into triangles')
+  parser.add_argument('--simplify', type=float, metavar='PIXELS',
+                      help='drop points within this distance of the '
+                      'simplified strokes, e.g. 0.5')
+  parser.add_argument('--lod', type=int, default=0, metavar='LEVELS',
+                      help='add up to this many simplified levels of detail '
+                      'for drawing the pictures small (up to %d)' % (
+                          len(picture_pack.LEVEL_SIZES) - 1))
+  parser.add_argument('--report', metavar='PATH',
+                      help='write the validation problems here as JSON')
+  parser.add_argument('--check', action='store_true',
+                      help='compare the NumPy and the plain Python versions')
+  args = parser.parse_args(argv[1:])
+  if args.check:
+    if numpy is None:
+      print 'NumPy is not available.'
+      return 1
+    return 1 if Check(args.sources) else 0
+  options = {}
+  if args.lines:
+    options['lines'] = True
+  if args.simplify:
+    options['simplify'] = args.simplify
+  if args.compact or args.delta:
+    options['compact'] = True
+  if args.delta:
+    options['delta'] = True
+  if args.mesh:
+    options['mesh'] = True
+  if args.lod:
+    options['lod'] = args.lod
+  if args.lines + (args.compact or args.delta) + args.mesh > 1:
+    print '--lines, --compact and --mesh cannot be combined.'
+    return 1
+  if (args.simplify or args.compact or args.mesh or args.lod) and (
+      numpy is None):
+    print '--simplify, --compact, --mesh and --lod need NumPy.'
+    return 1
+  if (args.lines or args.compact or args.delta or args.mesh or args.lod) and (
+      not args.output.endswith('.pack')):
+    print '--lines, --compact, --delta, --mesh and --lod need a .pack output.'
+    return 1
+  Build(args.sources, args.output, options, args.jobs,
+        incremental=not args.full, report_path=args.report)
 
-for word, data in all_the_words.iteritems():
-  print word
-  vbuf = GenerateVertexBuffer(data)
-  output.writestr(word, vbuf)
 
-output.close()
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,166 @@
+from OpenGL.GL import *
+
+# Keeps track of the GL state that the game changes all the time: the
+# program, the enabled capabilities, the blend function, the line width,
+# the bound textures and the uniforms. A change to the state it is
+# already in is not sent to GL, so each picture and each label can set
+# everything it needs without caring what was drawn before it.
+#
+# This only works if every change to this state goes through here. If
+# something else changes it, call Forget.
+#
+# The calls are counted, issued and skipped, for each frame. Call
+# EndFrame once per frame to get and reset the counts.
+
+
+class _Unknown(object):
+  def __repr__(self):
+    return 'unknown'
+
+# Never equal to a real value, so the first call always goes to GL.
+_UNKNOWN = _Unknown()
+
+
+class _Tracker(object):
+  def __init__(self):
+    self.frames = 0
+    self.total_issued = 0
+    self.total_skipped = 0
+    self.issued = 0
+    self.skipped = 0
+    self.Forget()
+
+  def Forget(self):
+    self.program = _UNKNOWN
+    self.enabled = {}
+    self.blend_func = _UNKNOWN
+    self.line_width = _UNKNOWN
+    self.textures = {}
+    # (program, location) -> values
+    self.uniforms = {}
+
+  # Returns True if the value needs to be sent to GL, and counts the call.
+  def _Changed(self, old, new):
+    if old is not _UNKNOWN and old == new:
+      self.skipped += 1
+      return False
+    self.issued += 1
+    return True
+
+  def UseProgram(self, program):
+    if self._Changed(self.program, program):
+      glUseProgram(program)
+      self.program = program
+
+  def Enable(self, cap):
+    if self._Changed(self.enabled.get(cap, _UNKNOWN), True):
+      glEnable(cap)
+      self.enabled[cap] = True
+
+  def Disable(self, cap):
+    if self._Changed(self.enabled.get(cap, _UNKNOWN), False):
+      glDisable(cap)
+      self.enabled[cap] = False
+
+  def IsEnabled(self, cap):
+    return self.enabled.get(cap) is True
+
+  def BlendFunc(self, src, dst):
+    if self._Changed(self.blend_func, (src, dst)):
+      glBlendFunc(src, dst)
+      self.blend_func = src, dst
+
+  # The blend function with a separate one for alpha. It is kept as a
+  # 4-tuple, so it never matches a plain BlendFunc.
+  def BlendFuncSeparate(self, src, dst, src_alpha, dst_alpha):
+    func = src, dst, src_alpha, dst_alpha
+    if self._Changed(self.blend_func, func):
+      glBlendFuncSeparate(*func)
+      self.blend_func = func
+
+  def LineWidth(self, width):
+    if self._Changed(self.line_width, width):
+      glLineWidth(width)
+      self.line_width = width
+
+  def BindTexture(self, target, texture):
+    if self._Changed(self.textures.get(target, _UNKNOWN), texture):
+      glBindTexture(target, texture)
+      self.textures[target] = texture
+
+  # Deleting a bound texture unbinds it, and its name may be reused.
+  def DeleteTexture(self, texture):
+    glDeleteTextures(texture)
+    for target, bound in self.textures.items():
+      if bound == texture:
+        self.textures[target] = 0
+
+  # Sets a uniform of the current program with a glUniform function.
+  def Uniform(self, function, location, *values):
+    key = self.program, location
+    if self._Changed(self.uniforms.get(key, _UNKNOWN), values):
+      function(location, *values)
+      self.uniforms[key] = values
+
+  # Sets a uniform array of floats of the current program with a
+  # glUniform*fv function. The values are a flat sequence, and are
+  # passed as a ctypes array, which PyOpenGL converts much faster than a
+  # list.
+  def UniformArray(self, function, location, count, values):
+    key = self.program, location
+    values = tuple(values)
+    if self._Changed(self.uniforms.get(key, _UNKNOWN), values):
+      function(location, count, (GLfloat * len(values))(*values))
+      self.uniforms[key] = values
+
+  # Returns the (issued, skipped) counts of the frame and starts a new
+  # frame.
+  def EndFrame(self):
+    counts = self.issued, self.skipped
+    self.frames += 1
+    self.total_issued += self.issued
+    self.total_skipped += self.skipped
+    self.issued = self.skipped = 0
+    return counts
+
+  def Stats(self):
+    frames = max(1, self.frames)
+    return '%.1f GL state calls issued, %.1f skipped per frame.' % (
+        float(self.total_issued) / frames, float(self.total_skipped) / frames)
+
+
+_tracker = _Tracker()
+Forget = _tracker.Forget
+UseProgram = _tracker.UseProgram
+Enable = _tracker.Enable
+Disable = _tracker.Disable
+IsEnabled = _tracker.IsEnabled
+BlendFunc = _tracker.BlendFunc
+BlendFuncSeparate = _tracker.BlendFuncSeparate
+LineWidth = _tracker.LineWidth
+BindTexture = _tracker.BindTexture
+DeleteTexture = _tracker.DeleteTexture
+Uniform = _tracker.Uniform
+UniformArray = _tracker.UniformArray
+EndFrame = _tracker.EndFrame
+Stats = _tracker.Stats
+
+
+# The current blend function, or None if blending is disabled. It is a
+# pair, or a 4-tuple from BlendFuncSeparate.
+def Blend():
+  if not _tracker.IsEnabled(GL_BLEND):
+    return None
+  return _tracker.blend_func
+
+
+# Sets the blend function, or disables blending for None.
+def SetBlend(func):
+  if func is None:
+    Disable(GL_BLEND)
+  else:
+    Enable(GL_BLEND)
+    if len(func) == 4:
+      BlendFuncSeparate(*func)
+    else:
+      BlendFunc(*func)
@@ -0,0 +1,241 @@
+import ctypes
+import math
+import struct
+import sys
+import time
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# WordPicture draws each segment of a picture as a GL_LINES pair. The
+# vertex buffer has the (x, y, time, pressure) of both ends, pushed a
+# bit outwards so the round caps fit, and the color buffer carries the
+# original endpoints for the fragment shader. Both have 8 floats per
+# segment.
+#
+# This is done either when a picture is loaded, or once by the asset
+# builder, which then stores the vertex and color buffers back to back.
+#
+# There is also a compact version of the points, with 8 bytes per
+# point instead of 16: x, y and time as normalized uint16, pressure as
+# normalized uint8 and a padding byte. All of them are in 0..1 already.
+# The expanded vertex buffer uses the same layout, and the color buffer
+# has the endpoints as 4 normalized uint16s, so the compact buffers are
+# half the size. The shader reads them as normalized attributes.
+
+COMPACT_POINT = struct.Struct('<HHHBx')
+
+
+# Takes the points of a picture (a ctypes float array, 4 floats per
+# point). Returns (lines, vbuf, cbuf).
+def ExpandLines(points):
+  if numpy is not None:
+    return _ExpandLinesNumPy(points)
+  return _ExpandLinesPython(points)
+
+
+def _ExpandLinesPython(points):
+  n = len(points) / 4
+  #n = 150
+  lines = n - 1
+
+  vbuf = (ctypes.c_float * (4 * 2 * lines))()
+  cbuf = (ctypes.c_float * (4 * 2 * lines))()
+
+  for i in xrange(lines):
+    v1_x = points[4 * i + 0]
+    v1_y = points[4 * i + 1]
+    v1_time = points[4 * i + 2]
+    v1_pressure = points[4 * i + 3]
+    v2_x = points[4 * i + 4]
+    v2_y = points[4 * i + 5]
+    v2_time = points[4 * i + 6]
+    v2_pressure = points[4 * i + 7]
+
+    n_x = v2_x - v1_x
+    n_y = v2_y - v1_y
+    d = math.hypot(n_x, n_y)
+    if d <= 0:
+      d = 0.005
+    else:
+      d = 0.005 / d
+
+    vbuf[8 * i + 0] = v1_x - d * n_x
+    vbuf[8 * i + 1] = v1_y - d * n_y
+    vbuf[8 * i + 2] = v1_time
+    vbuf[8 * i + 3] = v1_pressure
+    vbuf[8 * i + 4] = v2_x + d * n_x
+    vbuf[8 * i + 5] = v2_y + d * n_y
+    vbuf[8 * i + 6] = v2_time
+    vbuf[8 * i + 7] = v2_pressure
+
+    # Width in view space: pressure * 0.01 / 300. -ish
+
+    cbuf[8 * i + 0] = cbuf[8 * i + 4] = v1_x
+    cbuf[8 * i + 1] = cbuf[8 * i + 5] = v1_y
+    cbuf[8 * i + 2] = cbuf[8 * i + 6] = v2_x
+    cbuf[8 * i + 3] = cbuf[8 * i + 7] = v2_y
+
+    #print 'v%i: %r' % (i, ['%6.4f' % x for x in vbuf[8 * i + 0 : 8 * i + 8]])
+    #print 'c%i: %r' % (i, ['%6.4f' % x for x in cbuf[8 * i + 0 : 8 * i + 8]])
+  return lines, vbuf, cbuf
+
+
+# Same as _ExpandLinesPython, but on whole arrays. The math is done in
+# double precision like above, so the results are the same.
+def _ExpandLinesNumPy(points):
+  points = numpy.frombuffer(points, numpy.float32).reshape(-1, 4)
+  lines = len(points) - 1
+  vbuf = (ctypes.c_float * (4 * 2 * lines))()
+  cbuf = (ctypes.c_float * (4 * 2 * lines))()
+  v = numpy.frombuffer(vbuf, numpy.float32).reshape(lines, 2, 4)
+  c = numpy.frombuffer(cbuf, numpy.float32).reshape(lines, 2, 4)
+
+  v1 = points[:-1].astype(numpy.float64)
+  v2 = points[1:].astype(numpy.float64)
+  n = v2[:, :2] - v1[:, :2]
+  d = numpy.hypot(n[:, 0], n[:, 1])
+  positive = d > 0
+  d[positive] = 0.005 / d[positive]
+  d[~positive] = 0.005
+  d = d[:, numpy.newaxis] * n
+
+  v[:, 0, :2] = v1[:, :2] - d
+  v[:, 0, 2:] = v1[:, 2:]
+  v[:, 1, :2] = v2[:, :2] + d
+  v[:, 1, 2:] = v2[:, 2:]
+  c[:, :, :2] = v1[:, numpy.newaxis, :2]
+  c[:, :, 2:] = v2[:, numpy.newaxis, :2]
+  return lines, vbuf, cbuf
+
+
+# Takes a float32 NumPy array of points, shape (N, 4). Returns the
+# compact points as a string.
+def QuantizePoints(points):
+  compact = numpy.zeros((len(points), 4), dtype=numpy.uint16)
+  scale = numpy.array([65535, 65535, 65535, 255])
+  compact[:] = numpy.round(numpy.clip(points, 0, 1) * scale)
+  return compact.tostring()
+
+
+# The compact points, with each point stored as the difference from
+# the previous one (modulo 2^16 and 2^8). The differences are small, so
+# the pack compresses much better, for example in the distribution zip.
+def DeltaEncode(data):
+  compact = numpy.frombuffer(data, numpy.uint16).reshape(-1, 4)
+  deltas = numpy.diff(compact, axis=0)
+  deltas[:, 3] &= 0xff
+  return compact[:1].tostring() + deltas.tostring()
+
+
+# Undoes DeltaEncode. Takes and returns a ctypes byte array.
+def DeltaDecode(data):
+  decoded = (ctypes.c_ubyte * len(data))()
+  if numpy is not None:
+    deltas = numpy.frombuffer(data, numpy.uint16).reshape(-1, 4)
+    compact = numpy.frombuffer(decoded, numpy.uint16).reshape(-1, 4)
+    numpy.cumsum(deltas, axis=0, dtype=numpy.uint16, out=compact)
+    compact[:, 3] &= 0xff
+    return decoded
+  x = y = t = p = 0
+  for i in xrange(len(data) / COMPACT_POINT.size):
+    dx, dy, dt, dp = COMPACT_POINT.unpack_from(data, i * COMPACT_POINT.size)
+    x = (x + dx) & 0xffff
+    y = (y + dy) & 0xffff
+    t = (t + dt) & 0xffff
+    p = (p + dp) & 0xff
+    COMPACT_POINT.pack_into(decoded, i * COMPACT_POINT.size, x, y, t, p)
+  return decoded
+
+
+# Turns compact points (a ctypes byte array) back into floats, for when
+# the compact buffers cannot be used.
+def DequantizePoints(data):
+  n = len(data) / COMPACT_POINT.size
+  points = (ctypes.c_float * (4 * n))()
+  for i in xrange(n):
+    x, y, t, p = COMPACT_POINT.unpack_from(data, i * COMPACT_POINT.size)
+    points[4 * i + 0] = x / 65535.
+    points[4 * i + 1] = y / 65535.
+    points[4 * i + 2] = t / 65535.
+    points[4 * i + 3] = p / 255.
+  return points
+
+
+# Same as ExpandLines, but takes compact points (a ctypes byte array)
+# and returns compact buffers (ctypes byte arrays). Needs NumPy.
+def ExpandCompactLines(data):
+  points = numpy.frombuffer(data, numpy.uint16).reshape(-1, 4)
+  lines = len(points) - 1
+  vbuf = (ctypes.c_ubyte * (16 * lines))()
+  cbuf = (ctypes.c_ubyte * (16 * lines))()
+  v = numpy.frombuffer(vbuf, numpy.uint16).reshape(lines, 2, 4)
+  c = numpy.frombuffer(cbuf, numpy.uint16).reshape(lines, 2, 4)
+
+  v1 = points[:-1, :2] / 65535.
+  v2 = points[1:, :2] / 65535.
+  n = v2 - v1
+  d = numpy.hypot(n[:, 0], n[:, 1])
+  positive = d > 0
+  d[positive] = 0.005 / d[positive]
+  d[~positive] = 0.005
+  d = d[:, numpy.newaxis] * n
+
+  v[:, 0, :2] = numpy.round(numpy.clip(v1 - d, 0, 1) * 65535)
+  v[:, 1, :2] = numpy.round(numpy.clip(v2 + d, 0, 1) * 65535)
+  # Time, pressure and padding are just copied.
+  v[:, 0, 2:] = points[:-1, 2:]
+  v[:, 1, 2:] = points[1:, 2:]
+  c[:, :, :2] = points[:-1, numpy.newaxis, :2]
+  c[:, :, 2:] = points[1:, numpy.newaxis, :2]
+  return lines, vbuf, cbuf
+
+
+# The same buffers as ExpandLines, as one string.
+def PackLines(points):
+  lines, vbuf, cbuf = ExpandLines(points)
+  return buffer(vbuf)[:] + buffer(cbuf)[:]
+
+
+# Takes the output of PackLines as a ctypes float array. Returns (lines,
+# vbuf, cbuf), where the buffers are views into the array.
+def SplitLines(data):
+  lines = len(data) / 16
+  vbuf = (ctypes.c_float * (8 * lines)).from_buffer(data)
+  cbuf = (ctypes.c_float * (8 * lines)).from_buffer(data, 32 * lines)
+  return lines, vbuf, cbuf
+
+
+# Times both versions of ExpandLines on the largest pictures in a pack:
+#
+#   python line_buffers.py pictures.pack
+def Benchmark(pack_path, count=10, repeat=5):
+  import picture_pack
+  pack = picture_pack.Pack(pack_path)
+  pictures = []
+  for word in pack.words:
+    kind, data = pack.Read(word)[0]
+    if kind == picture_pack.KIND_POINTS:
+      pictures.append((len(data) / 4, word, data))
+  pictures.sort(reverse=True)
+  print '%-12s %7s %10s %10s %8s' % ('word', 'points', 'python', 'numpy', 'speedup')
+  for n, word, points in pictures[:count]:
+    timings = []
+    for expand in _ExpandLinesPython, _ExpandLinesNumPy:
+      start = time.time()
+      for i in xrange(repeat):
+        result = expand(points)
+      timings.append((time.time() - start) / repeat)
+      assert buffer(result[1])[:] + buffer(result[2])[:] == (
+          PackLines(points)), word
+    print '%-12s %7d %8.2fms %8.2fms %7.1fx' % (
+        word, n, timings[0] * 1000, timings[1] * 1000, timings[0] / timings[1])
+
+
+if __name__ == '__main__':
+  if numpy is None:
+    print 'NumPy is not available.'
+    sys.exit(1)
+  Benchmark(sys.argv[1] if len(sys.argv) > 1 else 'pictures.pack')
@@ -0,0 +1,131 @@
+import bisect
+import ctypes
+import mmap
+import struct
+
+# A pack of word pictures that can be memory mapped, instead of read
+# from a zip file. The layout is:
+#
+#   header   magic, version, entry count, index offset, names offset
+#   payloads arrays, each starting at a 16-byte boundary
+#   index    one entry per word and level, sorted by word and level
+#   names    the words of the entries, back to back
+#
+# The index comes after the payloads, so a pack can be written in one
+# pass without knowing all the words in advance. Looking up a word is
+# a binary search over the index, and reading it gives ctypes views
+# into the mapped file, without copying or decompressing anything.
+#
+# A word can have several levels of detail. Level 0 is the full
+# picture, and level k is simplified so that it is accurate to half a
+# pixel when the picture is drawn at most LEVEL_SIZES[k] pixels wide.
+
+MAGIC = 'LSPK'
+VERSION = 2
+ALIGNMENT = 16
+
+LEVEL_SIZES = (None, 150, 75, 38)
+
+# Payload kinds.
+KIND_POINTS = 0  # The (x, y, time, pressure) points from GenerateVertexBuffer.
+KIND_LINES = 1  # The expanded lines from line_buffers.PackLines.
+KIND_COMPACT = 2  # The points from line_buffers.QuantizePoints.
+KIND_COMPACT_DELTA = 3  # The same, after line_buffers.DeltaEncode.
+KIND_MESH = 4  # The triangle strip from stroke_mesh.TessellatePicture.
+
+# The ctypes element type of each kind of payload.
+PAYLOAD_TYPES = {
+  KIND_POINTS: ctypes.c_float,
+  KIND_LINES: ctypes.c_float,
+  KIND_COMPACT: ctypes.c_ubyte,
+  KIND_COMPACT_DELTA: ctypes.c_ubyte,
+  KIND_MESH: ctypes.c_float,
+}
+
+_HEADER = struct.Struct('<4sIIII12x')
+# name offset, payload offset, payload size, name length, kind, level
+_ENTRY = struct.Struct('<IIIHBB')
+
+
+class PackWriter(object):
+  def __init__(self, path):
+    self.file = open(path, 'wb')
+    self.file.write('\0' * _HEADER.size)
+    self.entries = {}
+
+  def Add(self, word, payload, kind=KIND_POINTS, level=0):
+    offset = self.file.tell()
+    padding = -offset % ALIGNMENT
+    self.file.write('\0' * padding)
+    offset += padding
+    self.file.write(payload)
+    # If a word is added twice, the last one wins.
+    self.entries[word, level] = offset, len(buffer(payload)), kind
+
+  def Close(self):
+    keys = sorted(self.entries)
+    index_offset = self.file.tell()
+    name_offset = 0
+    for word, level in keys:
+      offset, size, kind = self.entries[word, level]
+      self.file.write(_ENTRY.pack(
+          name_offset, offset, size, len(word), kind, level))
+      name_offset += len(word)
+    names_offset = self.file.tell()
+    self.file.write(''.join(word for word, level in keys))
+    self.file.seek(0)
+    self.file.write(_HEADER.pack(
+        MAGIC, VERSION, len(keys), index_offset, names_offset))
+    self.file.close()
+
+
+class Pack(object):
+  def __init__(self, path):
+    self.file = open(path, 'rb')
+    # A copy-on-write mapping, because ctypes only makes views of
+    # writable buffers. We never write to it, so the pages stay shared.
+    self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_COPY)
+    magic, version, count, index_offset, names_offset = (
+        _HEADER.unpack_from(self.data))
+    if magic != MAGIC or version != VERSION:
+      raise ValueError('%s is not a version %d picture pack.' % (path, VERSION))
+    self.entries = [
+      _ENTRY.unpack_from(self.data, index_offset + i * _ENTRY.size)
+      for i in xrange(count)]
+    # The word of each entry, and the list of distinct words.
+    self.names = [
+      self.data[names_offset + name_offset:
+                names_offset + name_offset + name_length]
+      for name_offset, _, _, name_length, _, _ in self.entries]
+    self.words = sorted(set(self.names))
+
+  # Returns the index of the first entry for a word, or None.
+  def Find(self, word):
+    i = bisect.bisect_left(self.names, word)
+    if i < len(self.names) and self.names[i] == word:
+      return i
+    return None
+
+  def __contains__(self, word):
+    return self.Find(word) is not None
+
+  # Returns a list of (kind, payload) pairs for a word, one for each
+  # level of detail. The payloads are ctypes arrays (see PAYLOAD_TYPES)
+  # that point into the mapped file.
+  def Read(self, word):
+    i = self.Find(word)
+    if i is None:
+      raise KeyError(word)
+    levels = []
+    while i < len(self.names) and self.names[i] == word:
+      _, offset, size, _, kind, level = self.entries[i]
+      assert level == len(levels), (word, level)
+      element = PAYLOAD_TYPES[kind]
+      count = size / ctypes.sizeof(element)
+      levels.append((kind, (element * count).from_buffer(self.data, offset)))
+      i += 1
+    return levels
+
+  def Close(self):
+    self.data.close()
+    self.file.close()
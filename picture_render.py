@@ -1,5 +1,15 @@
+import bisect
+import collections
 import ctypes
+import gl_state
+import line_buffers
 import math
+import multiprocessing.pool
+import os
+import picture_pack
+import threading
+import weakref
+import word_index
 import zipfile
 from OpenGL.GL import *
 
@@ -23,7 +33,7 @@ def CompileShader(src, kind, kind_name, name):
   return shader
 
 
-def BuildShader(name, vertex_shader_src, fragment_shader_src):
+def BuildShader(name, vertex_shader_src, fragment_shader_src, attributes=()):
   program = glCreateProgram()
   for kind, src, kind_name in (
     (GL_VERTEX_SHADER, vertex_shader_src, 'vertex'),
@@ -33,16 +43,60 @@ def BuildShader(name, vertex_shader_src, fragment_shader_src):
     shader = CompileShader(src, kind, kind_name, name)
     glAttachShader(program, shader)
     glDeleteShader(shader)
+  for location, attribute in attributes:
+    glBindAttribLocation(program, location, attribute)
   glLinkProgram(program)
   return program
 
 
-class Shaders(object):
-  @classmethod
-  def Setup(self):
-    self.line_drawing_program = BuildShader('line drawing', """
+# The part of the vertex shaders for batches. With SLOTS defined they
+# draw a batch of pictures (see RenderBatch). The slot attribute says
+# which picture a vertex belongs to, and the placement, times and colors
+# of the pictures are in uniform arrays. SetSlot hands them to the
+# fragment shader in varyings with the same names as its uniforms.
+BATCH_VERTEX_SHADER = """
+#ifdef SLOTS
+attribute float slot;
+uniform vec4 slot_placements[SLOTS];
+uniform vec4 slot_times[SLOTS];
+uniform vec4 slot_main_colors[SLOTS];
+uniform vec4 slot_tip_colors[SLOTS];
+
+varying float render_time;
+varying float unrender_time;
+varying vec4 main_color;
+varying vec4 tip_color;
+
+vec2 Place(vec2 v) {
+  vec4 placement = slot_placements[int(slot)];
+  return placement.xy + placement.z * v;
+}
+
+void SetSlot() {
+  int i = int(slot);
+  render_time = slot_times[i].x;
+  unrender_time = slot_times[i].y;
+  main_color = slot_main_colors[i];
+  tip_color = slot_tip_colors[i];
+}
+#else
+vec2 Place(vec2 v) {
+  return v;
+}
+
+void SetSlot() {
+}
+#endif
+"""
+
+# The vertex shader for drawing lines. The float buffers come in as
+# gl_Vertex and gl_Color, the compact ones (see line_buffers.py) as
+# normalized generic attributes.
+LINE_DRAWING_VERTEX_SHADER = """
 #version 120
 
+%(inputs)s
+""" + BATCH_VERTEX_SHADER + """
 varying float time;
 varying float pressure;
 
@@ -56,12 +110,15 @@ varying float d1;
 varying float d2;
 
 void main() {
-  gl_Position = gl_ModelViewProjectionMatrix * vec4(gl_Vertex.xy, 0, 1);
-  time = gl_Vertex.z;
-  pressure = gl_Vertex.w;
+  vec4 vertex = %(vertex)s;
+  vec4 ends = %(ends)s;
+  gl_Position = gl_ModelViewProjectionMatrix * vec4(Place(vertex.xy), 0, 1);
+  time = vertex.z;
+  pressure = vertex.w;
+  SetSlot();
 
-  v1 = (gl_ModelViewProjectionMatrix * vec4(gl_Color.xy, 0, 1)).xy;
-  v2 = (gl_ModelViewProjectionMatrix * vec4(gl_Color.zw, 0, 1)).xy;
+  v1 = (gl_ModelViewProjectionMatrix * vec4(Place(ends.xy), 0, 1)).xy;
+  v2 = (gl_ModelViewProjectionMatrix * vec4(Place(ends.zw), 0, 1)).xy;
   vec2 p = vec2(v2.x - v1.x, v2.y - v1.y);
   p = normalize(p);
   vec2 normal = vec2(p.y, -p.x);
@@ -70,9 +127,53 @@ void main() {
   line_dist = dot(normal, v2);
   d1 = dot(p, v1);
   d2 = dot(p, v2);
-}""", """
+}"""
+
+LINE_DRAWING_INPUTS = {
+  'inputs': '',
+  'vertex': 'gl_Vertex',
+  'ends': 'gl_Color',
+}
+
+COMPACT_LINE_DRAWING_INPUTS = {
+  'inputs': """attribute vec3 point;
+attribute float point_pressure;
+attribute vec4 endpoints;
+""",
+  'vertex': 'vec4(point, point_pressure)',
+  'ends': 'endpoints',
+}
+
+# Attribute locations for the compact buffers.
+POINT_ATTRIBUTE = 0
+POINT_PRESSURE_ATTRIBUTE = 1
+ENDPOINTS_ATTRIBUTE = 2
+COMPACT_ATTRIBUTES = (
+  (POINT_ATTRIBUTE, 'point'),
+  (POINT_PRESSURE_ATTRIBUTE, 'point_pressure'),
+  (ENDPOINTS_ATTRIBUTE, 'endpoints'),
+)
+# Attribute location for the slots of a batch. This is not one of the
+# locations that some drivers share with gl_Vertex or gl_Color.
+SLOT_ATTRIBUTE = 6
+
+# The vertex shader for drawing segments as instances (see Arena). Each
+# instance reads the two ends of a segment from the same point buffer,
+# and turns the four corners of a quad into a rectangle around the
+# segment, as wide as the fragment shader may draw.
+SEGMENT_VERTEX_SHADER = """
 #version 120
 
+attribute vec3 start_point;
+attribute float start_pressure;
+attribute vec3 end_point;
+attribute float end_pressure;
+// Along the segment (0 at the start, 1 at the end) and across it (-1 or
+// 1).
+attribute vec2 corner;
+
+uniform int viewport_width;
+""" + BATCH_VERTEX_SHADER + """
 varying float time;
 varying float pressure;
 
@@ -85,23 +186,62 @@ varying vec2 v2;
 varying float d1;
 varying float d2;
 
+void main() {
+  v1 = (gl_ModelViewProjectionMatrix * vec4(Place(start_point.xy), 0, 1)).xy;
+  v2 = (gl_ModelViewProjectionMatrix * vec4(Place(end_point.xy), 0, 1)).xy;
+  vec2 p = normalize(v2 - v1);
+  vec2 normal = vec2(p.y, -p.x);
+  line_normal = normal;
+  line_dist = dot(normal, v2);
+  d1 = dot(p, v1);
+  d2 = dot(p, v2);
+  time = mix(start_point.z, end_point.z, corner.x);
+  pressure = mix(start_pressure, end_pressure, corner.x);
+  SetSlot();
+
+  // The widest line, plus the antialiasing and a pixel to spare.
+  float reach = (max(start_pressure, end_pressure) * 0.005 + 1.0 / 350.0 +
+                 1.0 / viewport_width);
+  vec2 end = mix(v1 - reach * p, v2 + reach * p, corner.x);
+  gl_Position = vec4(end + corner.y * reach * normal, 0, 1);
+}"""
+
+# Attribute locations for drawing segments.
+START_POINT_ATTRIBUTE = 0
+START_PRESSURE_ATTRIBUTE = 1
+END_POINT_ATTRIBUTE = 2
+END_PRESSURE_ATTRIBUTE = 3
+CORNER_ATTRIBUTE = 4
+SEGMENT_ATTRIBUTES = (
+  (START_POINT_ATTRIBUTE, 'start_point'),
+  (START_PRESSURE_ATTRIBUTE, 'start_pressure'),
+  (END_POINT_ATTRIBUTE, 'end_point'),
+  (END_PRESSURE_ATTRIBUTE, 'end_pressure'),
+  (CORNER_ATTRIBUTE, 'corner'),
+)
+
+# The part of the fragment shaders that colors a line by its time: the
+# tip fades in with the tip color and turns into the main color, and
+# the part that is being erased fades out. Ramp returns the color, or
+# discards the fragment if it is not drawn yet or erased already.
+RAMP_FRAGMENT_SHADER = """
+#ifdef SLOTS
+varying float render_time;
+varying float unrender_time;
+varying vec4 main_color;
+varying vec4 tip_color;
+#else
 uniform float render_time;
 uniform float unrender_time;
+uniform vec4 main_color;
+uniform vec4 tip_color;
+#endif
 
 uniform float render_pre_time;
 uniform float render_post_time;
 uniform float unrender_pre_time;
-uniform vec4 main_color;
-uniform vec4 tip_color;
-
-uniform int viewport_width;
-uniform int viewport_height;
-
-void main() {
-  if (pressure <= 0) {
-    discard;
-  }
 
+vec4 Ramp(float time) {
   vec3 c;
   float a_mult = 1.0;
   if (time > render_time + render_pre_time) {
@@ -123,8 +263,35 @@ void main() {
     c = vec3(0, 0, 0);
     discard;
   }
+  return vec4(c, a_mult);
+}
+"""
+
+LINE_DRAWING_FRAGMENT_SHADER = """
+#version 120
+
+varying float time;
+varying float pressure;
+
+varying float line_dist;
+varying vec2 line_normal;
 
-  gl_FragColor.rgb = c;
+varying vec2 v1;
+varying vec2 v2;
+
+varying float d1;
+varying float d2;
+""" + RAMP_FRAGMENT_SHADER + """
+uniform int viewport_width;
+uniform int viewport_height;
+
+void main() {
+  if (pressure <= 0) {
+    discard;
+  }
+
+  vec4 ramp = Ramp(time);
+  gl_FragColor.rgb = ramp.rgb;
   float width = pressure * 0.005;
   vec2 coord = vec2(gl_FragCoord.x / viewport_width - 1,
                     gl_FragCoord.y / viewport_height - 1);
@@ -140,100 +307,512 @@ void main() {
     nd = length(vec2(nd, pd - d2));
   }
 
-  gl_FragColor.a = a_mult * clamp(1 - (nd - width) * 350, 0, 1);
+  gl_FragColor.a = ramp.a * clamp(1 - (nd - width) * 350, 0, 1);
 }
-""")
-    self.line_drawing_time = glGetUniformLocation(self.line_drawing_program,
-                                                  b'render_time')
-    self.line_drawing_untime = glGetUniformLocation(self.line_drawing_program,
-                                                    b'unrender_time')
+"""
 
-class WordPicture(object):
-  def __init__(self, vbuf):
-    n = len(vbuf) / 16
-    #n = 150
-    self.lines = lines = n - 1
-    points = (ctypes.c_float * (4 * n)).from_buffer_copy(vbuf)
-
-    self.vbuf = vbuf = (ctypes.c_float * (4 * 2 * lines))()
-    self.cbuf = cbuf = (ctypes.c_float * (4 * 2 * lines))()
-
-    for i in xrange(lines):
-      v1_x = points[4 * i + 0]
-      v1_y = points[4 * i + 1]
-      v1_time = points[4 * i + 2]
-      v1_pressure = points[4 * i + 3]
-      v2_x = points[4 * i + 4]
-      v2_y = points[4 * i + 5]
-      v2_time = points[4 * i + 6]
-      v2_pressure = points[4 * i + 7]
-
-      n_x = v2_x - v1_x
-      n_y = v2_y - v1_y
-      d = math.hypot(n_x, n_y)
-      if d <= 0:
-        d = 0.005
+# The vertex shader for drawing the triangle strips of stroke_mesh.py.
+# Each vertex is moved from its point by its extrusion, in line widths
+# on the screen. The width is where the line drawing shader is half
+# transparent, so the lines come out as wide, but with hard edges, for
+# the multisampling to smooth.
+MESH_VERTEX_SHADER = """
+#version 120
+
+attribute vec4 mesh_point;
+attribute vec2 extrusion;
+""" + BATCH_VERTEX_SHADER + """
+varying float time;
+
+void main() {
+  vec4 center = gl_ModelViewProjectionMatrix *
+      vec4(Place(mesh_point.xy), 0, 1);
+  vec2 direction = (gl_ModelViewProjectionMatrix * vec4(extrusion, 0, 0)).xy;
+  if (direction != vec2(0, 0)) {
+    direction = normalize(direction) * length(extrusion);
+  }
+  float width = mesh_point.w * 0.005 + 0.5 / 350.0;
+  gl_Position = vec4(center.xy + width * direction, 0, 1);
+  time = mesh_point.z;
+  SetSlot();
+}"""
+
+# The triangles cover just the lines, so all that is left is the color.
+MESH_FRAGMENT_SHADER = """
+#version 120
+
+varying float time;
+""" + RAMP_FRAGMENT_SHADER + """
+void main() {
+  gl_FragColor = Ramp(time);
+}
+"""
+
+# The floats of a mesh vertex: the point, then the extrusion. The same
+# as stroke_mesh.VERTEX_FLOATS.
+MESH_VERTEX_FLOATS = 6
+
+# Attribute locations for drawing meshes.
+MESH_POINT_ATTRIBUTE = 0
+EXTRUSION_ATTRIBUTE = 1
+MESH_ATTRIBUTES = (
+  (MESH_POINT_ATTRIBUTE, 'mesh_point'),
+  (EXTRUSION_ATTRIBUTE, 'extrusion'),
+)
+
+
+# The uniforms of the line drawing programs. Each program only has
+# some of them, the others are at location -1.
+LINE_DRAWING_UNIFORMS = (
+  'render_time', 'unrender_time', 'render_pre_time', 'render_post_time',
+  'unrender_pre_time', 'main_color', 'tip_color', 'viewport_width',
+  'viewport_height', 'slot_placements', 'slot_times', 'slot_main_colors',
+  'slot_tip_colors')
+
+# The most pictures in one batch draw. It is less if the vertex shader
+# does not have room for the uniform arrays.
+MAX_BATCH_SLOTS = 64
+
+
+# Returns a shader source that draws batches of slots pictures.
+def BatchSource(src, slots):
+  return src.replace('#version 120', '#version 120\n#define SLOTS %d' % slots)
+
+
+# Set to False to always draw the expanded lines, or to True to draw
+# instances even with a software renderer.
+USE_INSTANCING = None
+
+
+# Returns whether the segments can be drawn as instances. This needs
+# instanced arrays, base instances and indirect multi-draws, which are
+# all in OpenGL 4.3. Software renderers set up every instance
+# separately, which makes them about three times slower, so they keep
+# drawing lines unless USE_INSTANCING is True.
+def HasInstancing():
+  if USE_INSTANCING is False:
+    return False
+  version = glGetString(GL_VERSION).split()[0]
+  if tuple(int(v) for v in version.split('.')[:2]) < (4, 3):
+    return False
+  renderer = glGetString(GL_RENDERER).lower()
+  software = any(name in renderer
+                 for name in ('llvmpipe', 'softpipe', 'software'))
+  return USE_INSTANCING or not software
+
+
+# How LineBuffers are drawn: as expanded lines, as instances of a quad
+# for every segment (see Arena), or as triangle strips (see
+# stroke_mesh.py).
+LINES = 'lines'
+SEGMENTS = 'segments'
+MESH = 'mesh'
+
+
+class Shaders(object):
+  # Whether the pictures are drawn as instances. It is decided in Setup,
+  # before any pictures are loaded.
+  instanced = False
+
+  @classmethod
+  def Setup(self):
+    self.instanced = HasInstancing()
+    # Each slot takes 16 components, and the matrices and the rest some
+    # more.
+    components = glGetIntegerv(GL_MAX_VERTEX_UNIFORM_COMPONENTS)
+    self.batch_slots = min(MAX_BATCH_SLOTS, (components - 128) / 16)
+    # (compact, mode, batch) -> program
+    self.programs = {}
+    for batch in False, True:
+      def Source(src):
+        if batch:
+          return BatchSource(src, self.batch_slots)
+        return src
+      slot = [(SLOT_ATTRIBUTE, 'slot')] if batch else []
+      name = 'batch line drawing' if batch else 'line drawing'
+      self.programs[False, LINES, batch] = BuildShader(
+          name, Source(LINE_DRAWING_VERTEX_SHADER % LINE_DRAWING_INPUTS),
+          Source(LINE_DRAWING_FRAGMENT_SHADER), slot)
+      self.programs[True, LINES, batch] = BuildShader(
+          'compact ' + name,
+          Source(LINE_DRAWING_VERTEX_SHADER % COMPACT_LINE_DRAWING_INPUTS),
+          Source(LINE_DRAWING_FRAGMENT_SHADER),
+          list(COMPACT_ATTRIBUTES) + slot)
+      if self.instanced:
+        # The compact points only need other attribute pointers.
+        self.programs[False, SEGMENTS, batch] = (
+            self.programs[True, SEGMENTS, batch]) = (
+                BuildShader('segment ' + name, Source(SEGMENT_VERTEX_SHADER),
+                            Source(LINE_DRAWING_FRAGMENT_SHADER),
+                            list(SEGMENT_ATTRIBUTES) + slot))
+      self.programs[False, MESH, batch] = BuildShader(
+          'mesh ' + name, Source(MESH_VERTEX_SHADER),
+          Source(MESH_FRAGMENT_SHADER), list(MESH_ATTRIBUTES) + slot)
+    # program -> uniform name -> location
+    self.uniforms = {}
+    for program in self.programs.values():
+      self.uniforms[program] = dict(
+          (name, glGetUniformLocation(program, name))
+          for name in LINE_DRAWING_UNIFORMS)
+
+  # Returns the program for LineBuffers of a format.
+  @classmethod
+  def Program(self, compact, mode, batch=False):
+    return self.programs[compact, mode, batch]
+
+# Takes count from the first range in a sorted list of free (first,
+# count) ranges that has room, and returns its first, or None.
+def AllocateRange(free, count):
+  for i, (first, size) in enumerate(free):
+    if size >= count:
+      if size == count:
+        del free[i]
       else:
-        d = 0.005 / d
+        free[i] = first + count, size - count
+      return first
+  return None
 
-      vbuf[8 * i + 0] = v1_x - d * n_x
-      vbuf[8 * i + 1] = v1_y - d * n_y
-      vbuf[8 * i + 2] = v1_time
-      vbuf[8 * i + 3] = v1_pressure
-      vbuf[8 * i + 4] = v2_x + d * n_x
-      vbuf[8 * i + 5] = v2_y + d * n_y
-      vbuf[8 * i + 6] = v2_time
-      vbuf[8 * i + 7] = v2_pressure
 
-      # Width in view space: pressure * 0.01 / 300. -ish
+# Puts a range back in a sorted list of free ranges, merged with the
+# ranges next to it.
+def FreeRange(free, first, count):
+  i = bisect.bisect(free, (first, count))
+  free.insert(i, (first, count))
+  if i + 1 < len(free) and first + count == free[i + 1][0]:
+    free[i] = first, count + free.pop(i + 1)[1]
+  if i > 0 and sum(free[i - 1]) == first:
+    free[i - 1] = free[i - 1][0], free[i - 1][1] + free.pop(i)[1]
 
-      cbuf[8 * i + 0] = cbuf[8 * i + 4] = v1_x
-      cbuf[8 * i + 1] = cbuf[8 * i + 5] = v1_y
-      cbuf[8 * i + 2] = cbuf[8 * i + 6] = v2_x
-      cbuf[8 * i + 3] = cbuf[8 * i + 7] = v2_y
 
-      #print 'v%i: %r' % (i, ['%6.4f' % x for x in vbuf[8 * i + 0 : 8 * i + 8]])
-      #print 'c%i: %r' % (i, ['%6.4f' % x for x in cbuf[8 * i + 0 : 8 * i + 8]])
+# The vertices of the arena at the start. It doubles when it is full.
+ARENA_VERTICES = 1 << 16
 
-  # Sets up misc. render state for drawing word pictures. Can be
-  # called once followed by many Render calls.
+
+# One buffer object that holds the lines of many pictures of the same
+# format, so that they can be drawn without switching buffers, and with
+# a single draw call if they share a transform.
+#
+# The buffer has room for capacity vertices: the vbufs of the pictures
+# are in the first half, and their cbufs at the same index in the
+# second half. The free ranges are kept in a sorted list, and merged
+# when they are next to each other. Only use it on the render thread.
+#
+# A SEGMENTS arena holds the points of the pictures instead, and each
+# segment is drawn as an instance of a quad that reads its two ends
+# from the point buffer, once as the start and once, one point later,
+# as the end. This takes a quarter of the memory of the expanded lines,
+# and the points are uploaded straight from the pack.
+#
+# A MESH arena holds the triangle strips of the pictures, and has
+# nothing in the second half either.
+#
+# For RenderBatch there is a second buffer with the slot of every
+# vertex, one byte each. It is only written when a picture gets a
+# different slot than the last time it was drawn in a batch.
+class Arena(object):
+  # (compact, mode) -> Arena
+  arenas = {}
+  # The corners of the quad of a segment, for SEGMENTS arenas.
+  corners_vbo = None
+  # The commands of the last indirect draw, for SEGMENTS arenas.
+  indirect_vbo = None
+
+  # Returns the arena for a format, creating it if needed.
   @classmethod
-  def RenderSetup(cls, main_color, tip_color, viewport_width, viewport_height):
-    #glEnable(GL_LINE_SMOOTH)
-    glEnable(GL_BLEND)
-    glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
-    glLineWidth(6)
-
-    prg = Shaders.line_drawing_program
-    glUseProgram(prg)
-    l = glGetUniformLocation(prg, b'render_pre_time')
-    glUniform1f(l, 0.1)
-    l = glGetUniformLocation(prg, b'render_post_time')
-    glUniform1f(l, 0.2)
-    l = glGetUniformLocation(prg, b'unrender_pre_time')
-    glUniform1f(l, 0.8)
-    l = glGetUniformLocation(prg, b'main_color')
-    glUniform4f(l, *main_color)
-    l = glGetUniformLocation(prg, b'tip_color')
-    glUniform4f(l, *tip_color)
-    l = glGetUniformLocation(prg, b'viewport_width')
-    glUniform1i(l, viewport_width / 2)
-    l = glGetUniformLocation(prg, b'viewport_height')
-    glUniform1i(l, viewport_height / 2)
+  def For(cls, compact, mode):
+    if (compact, mode) not in cls.arenas:
+      cls.arenas[compact, mode] = Arena(compact, mode)
+    return cls.arenas[compact, mode]
 
-  # Draws into a square (0, 0) to (1, 1), positive x going right on
-  # the screen, positive y going up.
-  def Render(self, rtime, unrender_time=-10):
-    glUniform1f(Shaders.line_drawing_time, rtime)
-    glUniform1f(Shaders.line_drawing_untime, unrender_time)
-    if 1:
+  def __init__(self, compact, mode):
+    self.compact = compact
+    self.mode = mode
+    if mode == MESH:
+      self.vertex_size = 4 * MESH_VERTEX_FLOATS
+    else:
+      self.vertex_size = 8 if compact else 16
+    # Lines have a vbuf and a cbuf vertex, the others just one.
+    self.vertex_bytes = self.vertex_size
+    if mode == LINES:
+      self.vertex_bytes *= 2
+    self.vbo = glGenBuffers(1)
+    self.slots_vbo = glGenBuffers(1)
+    self.capacity = 0
+    self.free = []  # (first, count) pairs
+    self.blocks = {}  # first -> weak reference to the LineBuffers
+    self.slots = {}  # first -> the slot in the slots buffer
+    if mode == SEGMENTS and Arena.corners_vbo is None:
+      Arena.corners_vbo = glGenBuffers(1)
+      glBindBuffer(GL_ARRAY_BUFFER, Arena.corners_vbo)
+      glBufferData(GL_ARRAY_BUFFER, (ctypes.c_float * 8)(
+          0, -1, 0, 1, 1, -1, 1, 1), GL_STATIC_DRAW)
+      glBindBuffer(GL_ARRAY_BUFFER, 0)
+      Arena.indirect_vbo = glGenBuffers(1)
+    self.Grow(ARENA_VERTICES)
+
+  def Grow(self, capacity):
+    glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+    glBufferData(GL_ARRAY_BUFFER, capacity * self.vertex_bytes, None,
+                 GL_STATIC_DRAW)
+    old_capacity = self.capacity
+    self.capacity = capacity
+    self.Free(old_capacity, capacity - old_capacity)
+    # The cbufs moved, and the contents are gone, so upload everything
+    # again.
+    for first, block in self.blocks.items():
+      lines = block()
+      if lines is not None:
+        self.Write(first, lines)
+    glBindBuffer(GL_ARRAY_BUFFER, self.slots_vbo)
+    glBufferData(GL_ARRAY_BUFFER, capacity, None, GL_DYNAMIC_DRAW)
+    self.slots = {}
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+  # Returns the first of count free vertices, or None.
+  def Allocate(self, count):
+    return AllocateRange(self.free, count)
+
+  def Free(self, first, count):
+    FreeRange(self.free, first, count)
+
+  def Write(self, first, lines):
+    glBufferSubData(GL_ARRAY_BUFFER, first * self.vertex_size,
+                    ctypes.sizeof(lines.vbuf), lines.vbuf)
+    if self.mode == LINES:
+      glBufferSubData(GL_ARRAY_BUFFER,
+                      (self.capacity + first) * self.vertex_size,
+                      ctypes.sizeof(lines.cbuf), lines.cbuf)
+
+  # Uploads a LineBuffers and returns its first vertex. Its space is
+  # freed by ReleaseBuffers after it is gone.
+  def Add(self, lines):
+    count = lines.vertices
+    first = self.Allocate(count)
+    if first is None:
+      self.Grow(max(2 * self.capacity, self.capacity + count))
+      first = self.Allocate(count)
+    self.blocks[first] = weakref.ref(
+        lines, lambda _: _released_blocks.append((self, first, count)))
+    glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+    self.Write(first, lines)
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
+    LineBuffers.gpu_bytes += count * self.vertex_bytes
+    return first
+
+  # Binds the buffer and sets up the vertex arrays to draw from it.
+  def Begin(self):
+    glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+    if self.mode == MESH:
+      size = self.vertex_size
+      glVertexAttribPointer(MESH_POINT_ATTRIBUTE, 4, GL_FLOAT, GL_FALSE, size,
+                            ctypes.c_void_p(0))
+      glVertexAttribPointer(EXTRUSION_ATTRIBUTE, 2, GL_FLOAT, GL_FALSE, size,
+                            ctypes.c_void_p(16))
+      for attribute in MESH_ATTRIBUTES:
+        glEnableVertexAttribArray(attribute[0])
+      return
+    if self.mode == SEGMENTS:
+      if self.compact:
+        point_type, pressure_type, normalized = (
+            GL_UNSIGNED_SHORT, GL_UNSIGNED_BYTE, GL_TRUE)
+        pressure_offset = 6
+      else:
+        point_type, pressure_type, normalized = GL_FLOAT, GL_FLOAT, GL_FALSE
+        pressure_offset = 12
+      size = self.vertex_size
+      for point, pressure, offset in (
+          (START_POINT_ATTRIBUTE, START_PRESSURE_ATTRIBUTE, 0),
+          (END_POINT_ATTRIBUTE, END_PRESSURE_ATTRIBUTE, size)):
+        glVertexAttribPointer(point, 3, point_type, normalized, size,
+                              ctypes.c_void_p(offset))
+        glVertexAttribPointer(pressure, 1, pressure_type, normalized, size,
+                              ctypes.c_void_p(offset + pressure_offset))
+        glVertexAttribDivisor(point, 1)
+        glVertexAttribDivisor(pressure, 1)
+      glBindBuffer(GL_ARRAY_BUFFER, Arena.corners_vbo)
+      glVertexAttribPointer(CORNER_ATTRIBUTE, 2, GL_FLOAT, GL_FALSE, 8,
+                            ctypes.c_void_p(0))
+      for attribute in SEGMENT_ATTRIBUTES:
+        glEnableVertexAttribArray(attribute[0])
+      return
+    cbuf = ctypes.c_void_p(self.capacity * self.vertex_size)
+    if self.compact:
+      for attribute in COMPACT_ATTRIBUTES:
+        glEnableVertexAttribArray(attribute[0])
+      glVertexAttribPointer(POINT_ATTRIBUTE, 3, GL_UNSIGNED_SHORT, GL_TRUE,
+                            8, ctypes.c_void_p(0))
+      glVertexAttribPointer(POINT_PRESSURE_ATTRIBUTE, 1, GL_UNSIGNED_BYTE,
+                            GL_TRUE, 8, ctypes.c_void_p(6))
+      glVertexAttribPointer(ENDPOINTS_ATTRIBUTE, 4, GL_UNSIGNED_SHORT, GL_TRUE,
+                            8, cbuf)
+    else:
       glEnableClientState(GL_VERTEX_ARRAY)
       glEnableClientState(GL_COLOR_ARRAY)
-      glVertexPointer(4, GL_FLOAT, 16, self.vbuf)
-      glColorPointer(4, GL_FLOAT, 16, self.cbuf)
-      glDrawArrays(GL_LINES, 0, 2 * self.lines)
+      glVertexPointer(4, GL_FLOAT, 16, ctypes.c_void_p(0))
+      glColorPointer(4, GL_FLOAT, 16, cbuf)
+
+  # Sets the slots of the blocks, a list of (first, count, slot), and
+  # sets up the slot attribute, between Begin and End. In a SEGMENTS
+  # arena the slot is per instance.
+  def BeginSlots(self, blocks):
+    glBindBuffer(GL_ARRAY_BUFFER, self.slots_vbo)
+    for first, count, slot in blocks:
+      if self.slots.get(first) != slot:
+        glBufferSubData(GL_ARRAY_BUFFER, first, count, chr(slot) * count)
+        self.slots[first] = slot
+    glEnableVertexAttribArray(SLOT_ATTRIBUTE)
+    glVertexAttribPointer(SLOT_ATTRIBUTE, 1, GL_UNSIGNED_BYTE, GL_FALSE, 1,
+                          ctypes.c_void_p(0))
+    if self.mode == SEGMENTS:
+      glVertexAttribDivisor(SLOT_ATTRIBUTE, 1)
+
+  def EndSlots(self):
+    glDisableVertexAttribArray(SLOT_ATTRIBUTE)
+    if self.mode == SEGMENTS:
+      glVertexAttribDivisor(SLOT_ATTRIBUTE, 0)
+
+  # Draws a list of LineBuffers of the arena, between Begin and End,
+  # with one call.
+  def Draw(self, lines):
+    if self.mode == MESH:
+      if len(lines) == 1:
+        glDrawArrays(GL_TRIANGLE_STRIP, lines[0].first, lines[0].vertices)
+      else:
+        glMultiDrawArrays(GL_TRIANGLE_STRIP, [l.first for l in lines],
+                          [l.vertices for l in lines], len(lines))
+    elif self.mode == LINES:
+      if len(lines) == 1:
+        glDrawArrays(GL_LINES, lines[0].first, 2 * lines[0].lines)
+      else:
+        # Lists, because PyOpenGL has GLsizei as a 64-bit type, and the
+        # driver would read the counts of a (GLsizei * n) array wrong.
+        glMultiDrawArrays(GL_LINES, [l.first for l in lines],
+                          [2 * l.lines for l in lines], len(lines))
+    elif len(lines) == 1:
+      glDrawArraysInstancedBaseInstance(GL_TRIANGLE_STRIP, 0, 4,
+                                        lines[0].lines, lines[0].first)
+    else:
+      # (vertices, instances, first vertex, first instance) for each.
+      commands = (ctypes.c_uint * (4 * len(lines)))()
+      for i, l in enumerate(lines):
+        commands[4 * i:4 * i + 4] = [4, l.lines, 0, l.first]
+      glBindBuffer(GL_DRAW_INDIRECT_BUFFER, Arena.indirect_vbo)
+      glBufferData(GL_DRAW_INDIRECT_BUFFER, commands, GL_STREAM_DRAW)
+      glMultiDrawArraysIndirect(GL_TRIANGLE_STRIP, None, len(lines), 0)
+      glBindBuffer(GL_DRAW_INDIRECT_BUFFER, 0)
+
+  def End(self):
+    if self.mode == MESH:
+      for attribute in MESH_ATTRIBUTES:
+        glDisableVertexAttribArray(attribute[0])
+    elif self.mode == SEGMENTS:
+      for attribute in SEGMENT_ATTRIBUTES:
+        glDisableVertexAttribArray(attribute[0])
+        glVertexAttribDivisor(attribute[0], 0)
+    elif self.compact:
+      for attribute in COMPACT_ATTRIBUTES:
+        glDisableVertexAttribArray(attribute[0])
+    else:
       glDisableClientState(GL_VERTEX_ARRAY)
       glDisableClientState(GL_COLOR_ARRAY)
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+
+# The arena blocks of LineBuffers that are gone, to be freed on the
+# render thread by ReleaseBuffers. (list.append is atomic, so any
+# thread can add to it.)
+_released_blocks = []
+
+
+# The same for the atlas squares of WordPictures that are gone, with
+# their weak references.
+_released_squares = []
+
+
+def ReleaseBuffers():
+  while _released_blocks:
+    arena, first, count = _released_blocks.pop()
+    del arena.blocks[first]
+    arena.slots.pop(first, None)
+    arena.Free(first, count)
+    LineBuffers.gpu_bytes -= count * arena.vertex_bytes
+  while _released_squares:
+    textures.Delete(*_released_squares.pop())
+
+
+# The line buffers for one level of detail of a picture.
+#
+# They are uploaded to the arena of their format the first time they
+# are drawn. Their space is freed when the LineBuffers is gone, which
+# is when its picture leaves the loader's cache, or when the last
+# WordPicture using it is gone, if that is later.
+#
+# If Shaders.instanced, the points are kept as they are for a SEGMENTS
+# arena, and nothing is expanded. The expanded lines in a KIND_LINES
+# pack are still drawn as lines, and the triangle strips of a KIND_MESH
+# pack are drawn as they are. For those, lines is the number of
+# triangles.
+class LineBuffers(object):
+  # The bytes used in the arenas.
+  gpu_bytes = 0
+
+  # Takes a (kind, data) pair from the pack. See picture_pack.py and
+  # line_buffers.py for the kinds.
+  def __init__(self, kind, data):
+    self.compact = False
+    self.mode = LINES
+    self.arena = None
+    if kind == picture_pack.KIND_MESH:
+      self.mode = MESH
+      self.vertices = len(data) / MESH_VERTEX_FLOATS
+      self.lines = max(0, self.vertices - 2)
+      self.vbuf = data
+      self.cbuf = None
+      self.bytes = 0
+      return
+    if kind == picture_pack.KIND_LINES:
+      self.lines, self.vbuf, self.cbuf = line_buffers.SplitLines(data)
+      self.vertices = 2 * self.lines
+      # These point into the mapped pack, so they take no memory.
+      self.bytes = 0
+      return
+    if kind == picture_pack.KIND_COMPACT_DELTA:
+      data = line_buffers.DeltaDecode(data)
+      kind = picture_pack.KIND_COMPACT
+    if Shaders.instanced:
+      self.mode = SEGMENTS
+      self.compact = kind == picture_pack.KIND_COMPACT
+      points = len(data) / 4 if kind == picture_pack.KIND_POINTS else (
+          len(data) / line_buffers.COMPACT_POINT.size)
+      self.lines = max(0, points - 1)
+      self.vertices = points
+      self.vbuf = data
+      self.cbuf = None
+      # A view into the mapped pack keeps the map in _objects and takes
+      # no memory. Only zip copies and decoded deltas own theirs.
+      self.bytes = ctypes.sizeof(data) if data._objects is None else 0
+      return
+    if kind == picture_pack.KIND_COMPACT and line_buffers.numpy is not None:
+      self.compact = True
+      self.lines, self.vbuf, self.cbuf = line_buffers.ExpandCompactLines(data)
+    else:
+      if kind == picture_pack.KIND_COMPACT:
+        data = line_buffers.DequantizePoints(data)
+      self.lines, self.vbuf, self.cbuf = line_buffers.ExpandLines(data)
+    self.vertices = 2 * self.lines
+    self.bytes = ctypes.sizeof(self.vbuf) + ctypes.sizeof(self.cbuf)
+
+  # Makes sure the lines are in the arena, and returns the arena.
+  def Upload(self):
+    if self.arena is None:
+      self.arena = Arena.For(self.compact, self.mode)
+      self.first = self.arena.Add(self)
+    return self.arena
+
+  # Draws the lines, between Begin and End of their arena.
+  def Draw(self):
+    if 1:
+      self.arena.Draw([self])
     else:
       glBegin(GL_LINES)
 
@@ -254,17 +833,633 @@ class WordPicture(object):
       glEnd()
 
 
-class WordPictureLoader(object):
+# The geometry of a word, shared by all the WordPictures of the word.
+class WordGeometry(object):
+  # Takes a list of (kind, data) pairs, one for each level of detail.
+  # Only the first level is expanded right away, the others when they
+  # are first drawn.
+  def __init__(self, levels):
+    self.sources = levels
+    self.levels = [LineBuffers(*levels[0])] + [None] * (len(levels) - 1)
+    self.compact = self.levels[0].compact
+    self.mode = self.levels[0].mode
+
+  # The memory taken by the expanded levels.
+  def Bytes(self):
+    return sum(level.bytes for level in self.levels if level is not None)
+
+  # Returns the LineBuffers to draw the picture at a size, in pixels.
+  def Level(self, size=None):
+    level = 0
+    if size is not None:
+      while (level + 1 < len(self.levels) and
+             size <= picture_pack.LEVEL_SIZES[level + 1]):
+        level += 1
+    if self.levels[level] is None:
+      self.levels[level] = LineBuffers(*self.sources[level])
+    return self.levels[level]
+
+
+# Sets up the render state shared by all the line drawing programs, and
+# returns the uniform locations of the program.
+def UseLineDrawingProgram(program, viewport_width, viewport_height):
+  ReleaseBuffers()
+  #glEnable(GL_LINE_SMOOTH)
+  gl_state.Enable(GL_BLEND)
+  gl_state.BlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+  gl_state.LineWidth(6)
+
+  gl_state.UseProgram(program)
+  uniforms = Shaders.uniforms[program]
+  gl_state.Uniform(glUniform1f, uniforms['render_pre_time'], 0.1)
+  gl_state.Uniform(glUniform1f, uniforms['render_post_time'], 0.2)
+  gl_state.Uniform(glUniform1f, uniforms['unrender_pre_time'], 0.8)
+  gl_state.Uniform(glUniform1i, uniforms['viewport_width'],
+                   viewport_width / 2)
+  gl_state.Uniform(glUniform1i, uniforms['viewport_height'],
+                   viewport_height / 2)
+  return uniforms
+
+
+# One use of a word picture. The game keeps its colors, timing and
+# placement here, while the geometry is shared.
+#
+# From WordPictureLoader.LoadWordPicture the geometry may still be
+# loading. Then it cannot be drawn until Ready returns True.
+class WordPicture(object):
+  __slots__ = ('geometry', 'pending', 'cached', 'primary', 'secondary',
+               'accepted', 'start', 'x', 'y', 'scale', '__weakref__')
+
+  def __init__(self, geometry, pending=None):
+    self.geometry = geometry
+    self.pending = pending
+    # (key, square in the atlas) from RenderCachedBatch
+    self.cached = None
+
+  # Returns whether the picture can be drawn. Call it from the render
+  # thread, which takes over the geometry here.
+  def Ready(self):
+    if self.geometry is None:
+      if not self.pending.ready():
+        return False
+      self.geometry = self.pending.get()
+      self.pending = None
+    return True
+
+  # Sets up misc. render state for drawing word pictures. Can be
+  # called once followed by many Render calls, for pictures of the
+  # same format.
+  def RenderSetup(self, main_color, tip_color, viewport_width, viewport_height):
+    prg = Shaders.Program(self.geometry.compact, self.geometry.mode)
+    uniforms = UseLineDrawingProgram(prg, viewport_width, viewport_height)
+    gl_state.Uniform(glUniform4f, uniforms['main_color'], *main_color)
+    gl_state.Uniform(glUniform4f, uniforms['tip_color'], *tip_color)
+
+  # Sets the times for the following Render calls. Call it after
+  # RenderSetup.
+  def SetTime(self, rtime, unrender_time):
+    uniforms = Shaders.uniforms[
+        Shaders.Program(self.geometry.compact, self.geometry.mode)]
+    gl_state.Uniform(glUniform1f, uniforms['render_time'], rtime)
+    gl_state.Uniform(glUniform1f, uniforms['unrender_time'], unrender_time)
+
+  # Draws into a square (0, 0) to (1, 1), positive x going right on
+  # the screen, positive y going up. If the size of the square on the
+  # screen is given in pixels, a simpler level of detail may be used.
+  def Render(self, rtime, unrender_time=-10, size=None):
+    self.SetTime(rtime, unrender_time)
+    lines = self.geometry.Level(size)
+    if not lines.lines:
+      return
+    arena = lines.Upload()
+    arena.Begin()
+    lines.Draw()
+    arena.End()
+
+
+# Draws many pictures that share a RenderSetup. If placements are
+# given, they are (x, y, scale) for each picture, the position of its
+# square and its size relative to the current transform, and the size
+# is scaled too. Otherwise all the pictures are drawn at the same
+# place, with one draw call for each format.
+def RenderMany(pictures, rtime, unrender_time=-10, size=None,
+               placements=None):
+  if not pictures:
+    return
+  pictures[0].SetTime(rtime, unrender_time)
+  if placements is None:
+    placements = [None] * len(pictures)
+  # arena -> list of (lines, placement)
+  batches = collections.OrderedDict()
+  for picture, placement in zip(pictures, placements):
+    level_size = size
+    if size is not None and placement is not None:
+      level_size = size * placement[2]
+    lines = picture.geometry.Level(level_size)
+    if lines.lines:
+      batches.setdefault(lines.Upload(), []).append((lines, placement))
+  for arena, batch in batches.iteritems():
+    arena.Begin()
+    if batch[0][1] is None:
+      arena.Draw([lines for lines, _ in batch])
+    else:
+      for lines, (x, y, scale) in batch:
+        glPushMatrix()
+        glTranslate(x, y, 0)
+        glScale(scale, scale, 1.0)
+        lines.Draw()
+        glPopMatrix()
+    arena.End()
+
+
+# One picture of a RenderBatch: the position of its square and its size
+# (see RenderMany), its times (see WordPicture.Render) and its colors
+# (see WordPicture.RenderSetup).
+BatchItem = collections.namedtuple(
+    'BatchItem',
+    'picture placement rtime unrender_time main_color tip_color')
+
+
+# Draws many pictures, each with its own placement, times and colors,
+# with one draw call for every Shaders.batch_slots pictures of
+# the same format. The pictures do not need a RenderSetup. If the size
+# of a picture of scale 1 is given in pixels, simpler levels of detail
+# may be used.
+def RenderBatch(items, viewport_width, viewport_height, size=None):
+  # arena -> list of (lines, item)
+  batches = collections.OrderedDict()
+  for item in items:
+    level_size = size
+    if size is not None:
+      level_size = size * item.placement[2]
+    lines = item.picture.geometry.Level(level_size)
+    if lines.lines:
+      batches.setdefault(lines.Upload(), []).append((lines, item))
+  for arena, batch in batches.iteritems():
+    program = Shaders.Program(arena.compact, arena.mode, batch=True)
+    uniforms = UseLineDrawingProgram(program, viewport_width, viewport_height)
+    arena.Begin()
+    # The same lines cannot have two slots in one draw, so a picture
+    # that is there twice starts a new one.
+    chunks = [[]]
+    in_chunk = set()
+    for lines, item in batch:
+      chunk = chunks[-1]
+      if len(chunk) == Shaders.batch_slots or lines.first in in_chunk:
+        chunk = []
+        chunks.append(chunk)
+        in_chunk = set()
+      chunk.append((lines, item))
+      in_chunk.add(lines.first)
+    for chunk in chunks:
+      arena.BeginSlots([(lines.first, lines.vertices, slot)
+                        for slot, (lines, item) in enumerate(chunk)])
+      placements = []
+      times = []
+      main_colors = []
+      tip_colors = []
+      for lines, item in chunk:
+        placements.extend(tuple(item.placement) + (0,))
+        times.extend((item.rtime, item.unrender_time, 0, 0))
+        main_colors.extend(item.main_color)
+        tip_colors.extend(item.tip_color)
+      for name, values in (('slot_placements', placements),
+                           ('slot_times', times),
+                           ('slot_main_colors', main_colors),
+                           ('slot_tip_colors', tip_colors)):
+        gl_state.UniformArray(glUniform4fv, uniforms[name], len(chunk), values)
+      arena.Draw([lines for lines, _ in chunk])
+      arena.EndSlots()
+    arena.End()
+
+
+# The most pixels on a side of the texture atlas of RenderCachedBatch.
+# It takes 16 MB.
+ATLAS_SIZE = 2048
+
+# The samples per pixel of the pictures in the atlas, like the screen
+# has.
+ATLAS_SAMPLES = 4
+
+
+# The squares of RenderCachedBatch in one texture atlas, so that all the
+# pictures are drawn with one texture. Each picture has at most one
+# square, which is drawn again when the picture is drawn differently.
+#
+# The squares are packed on shelves, rows as high as the first square
+# on them, and the free spans of a shelf are kept like the free ranges
+# of an Arena. When a square does not fit, the least recently drawn
+# ones make room. The squares of the pictures that are gone are freed
+# by ReleaseBuffers. Only use it on the render thread.
+#
+# A picture is drawn in a framebuffer object with the same viewport as
+# the screen, so the lines are just as wide, and only the corner with
+# the picture is kept and copied into the atlas. The colors are
+# premultiplied by alpha, so the quads blend like the pictures
+# themselves.
+class TextureCache(object):
   def __init__(self):
-    self.source = zipfile.ZipFile('pictures_vbuf.zip', 'r')
-    self.all_words = self.source.namelist()
+    # (x, y, size) square in the atlas -> weak reference to the
+    # WordPicture, the least recently drawn first
+    self.squares = collections.OrderedDict()
+    # [y, height, free spans] for each shelf, from the bottom up
+    self.shelves = []
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self.available = None
+
+  # Returns whether pictures can be drawn into the atlas. Checked on the
+  # first call, which needs a GL context.
+  def Available(self):
+    if self.available is None:
+      self.available = bool(glGenFramebuffers) and bool(glBlitFramebuffer)
+      if self.available:
+        self.size = min(ATLAS_SIZE, glGetIntegerv(GL_MAX_TEXTURE_SIZE))
+        self.samples = min(ATLAS_SAMPLES, glGetIntegerv(GL_MAX_SAMPLES))
+        self.texture = glGenTextures(1)
+        gl_state.BindTexture(GL_TEXTURE_2D, self.texture)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA8, self.size, self.size, 0,
+                     GL_RGBA, GL_UNSIGNED_BYTE, None)
+        # One framebuffer to draw in, multisampled if possible, and one
+        # to copy it into the atlas.
+        self.fbo = glGenFramebuffers(1)
+        self.atlas_fbo = glGenFramebuffers(1)
+        framebuffer = glGetIntegerv(GL_FRAMEBUFFER_BINDING)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.atlas_fbo)
+        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0,
+                               GL_TEXTURE_2D, self.texture, 0)
+        glBindFramebuffer(GL_FRAMEBUFFER, framebuffer)
+    return self.available
+
+  # Returns the (x, y) of a free square, or None. It goes on the lowest
+  # shelf that it fits, or on a new one.
+  def _Allocate(self, size):
+    best = None
+    for shelf in self.shelves:
+      if size <= shelf[1] and (best is None or shelf[1] < best[1]) and any(
+          span >= size for _, span in shelf[2]):
+        best = shelf
+    if best is None:
+      y = sum(self.shelves[-1][:2]) if self.shelves else 0
+      if y + size > self.size:
+        return None
+      best = [y, size, [(0, self.size)]]
+      self.shelves.append(best)
+    return AllocateRange(best[2], size), best[0]
+
+  def _Free(self, square):
+    x, y, size = square
+    for shelf in self.shelves:
+      if shelf[0] == y:
+        FreeRange(shelf[2], x, size)
+    # The empty shelves at the top can be used for any height again.
+    while self.shelves and self.shelves[-1][2] == [(0, self.size)]:
+      self.shelves.pop()
+
+  # Frees a square. If the weak reference of a picture that is gone is
+  # given, only if the square is still that picture's.
+  def Delete(self, square, ref=None):
+    if square in self.squares and ref in (None, self.squares[square]):
+      del self.squares[square]
+      self._Free(square)
+
+  # Returns the square of a picture, drawn for a key from
+  # RenderCachedBatch, or None if there is no room. The squares in keep
+  # are not dropped to make room.
+  def Square(self, picture, key, keep):
+    if picture.cached is not None:
+      if picture.cached[0] == key:
+        square = picture.cached[1]
+        self.squares[square] = self.squares.pop(square)
+        self.hits += 1
+        return square
+      self.Delete(picture.cached[1])
+      picture.cached = None
+    pixels = key[-1]
+    position = self._Allocate(pixels)
+    while position is None:
+      for oldest, ref in self.squares.iteritems():
+        if oldest not in keep:
+          break
+      else:
+        return None
+      old_picture = ref()
+      if old_picture is not None:
+        old_picture.cached = None
+      self.Delete(oldest)
+      position = self._Allocate(pixels)
+    square = position + (pixels,)
+    self.Draw(picture, key, square)
+    picture.cached = key, square
+    self.squares[square] = weakref.ref(
+        picture, lambda ref: _released_squares.append((square, ref)))
+    self.misses += 1
+    return square
+
+  # Draws a picture into its square of the atlas.
+  def Draw(self, picture, key, square):
+    (rtime, unrender_time, main_color, tip_color, viewport_width,
+     viewport_height, pixels) = key
+    x, y, _ = square
+    framebuffer = glGetIntegerv(GL_FRAMEBUFFER_BINDING)
+    viewport = glGetIntegerv(GL_VIEWPORT)
+    clear_color = glGetFloatv(GL_COLOR_CLEAR_VALUE)
+    renderbuffer = glGenRenderbuffers(1)
+    glBindRenderbuffer(GL_RENDERBUFFER, renderbuffer)
+    glRenderbufferStorageMultisample(GL_RENDERBUFFER, self.samples,
+                                     GL_RGBA8, pixels, pixels)
+    glBindRenderbuffer(GL_RENDERBUFFER, 0)
+    glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+    glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0,
+                              GL_RENDERBUFFER, renderbuffer)
+    glViewport(0, 0, viewport_width, viewport_height)
+    gl_state.Enable(GL_SCISSOR_TEST)
+    glScissor(0, 0, pixels, pixels)
+    glClearColor(0, 0, 0, 0)
+    glClear(GL_COLOR_BUFFER_BIT)
+    glMatrixMode(GL_PROJECTION)
+    glPushMatrix()
+    glLoadIdentity()
+    glMatrixMode(GL_MODELVIEW)
+    glPushMatrix()
+    glLoadIdentity()
+    glTranslate(-1, -1, 0)
+    glScale(2.0 * pixels / viewport_width, 2.0 * pixels / viewport_height, 1)
+    picture.RenderSetup(main_color, tip_color, viewport_width, viewport_height)
+    gl_state.BlendFuncSeparate(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA,
+                               GL_ONE, GL_ONE_MINUS_SRC_ALPHA)
+    picture.Render(rtime, unrender_time, pixels)
+    glPopMatrix()
+    glMatrixMode(GL_PROJECTION)
+    glPopMatrix()
+    glMatrixMode(GL_MODELVIEW)
+    gl_state.Disable(GL_SCISSOR_TEST)
+    glBindFramebuffer(GL_READ_FRAMEBUFFER, self.fbo)
+    glBindFramebuffer(GL_DRAW_FRAMEBUFFER, self.atlas_fbo)
+    glBlitFramebuffer(0, 0, pixels, pixels, x, y, x + pixels, y + pixels,
+                      GL_COLOR_BUFFER_BIT, GL_NEAREST)
+    glDeleteRenderbuffers(1, [renderbuffer])
+    glBindFramebuffer(GL_FRAMEBUFFER, framebuffer)
+    glViewport(*viewport)
+    glClearColor(*clear_color)
+
+  def Stats(self):
+    return '%d pictures in the atlas, %d hits, %d misses.' % (
+        len(self.squares), self.hits, self.misses)
+
+
+textures = TextureCache()
+
+
+# Draws pictures like RenderBatch, but from the texture atlas: each
+# picture is a quad, and all of them are one draw call. It is for
+# pictures that stay the same for a while, like the fully drawn ones.
+# A picture is only drawn into the atlas again when its times, its
+# colors or its size change. The size of a picture of scale 1 on the
+# screen is needed, in pixels. The pictures that do not fit in the
+# atlas, or all of them if textures cannot be drawn, go to RenderBatch.
+def RenderCachedBatch(items, viewport_width, viewport_height, size):
+  ReleaseBuffers()
+  quads = []
+  uncached = []
+  keep = set()
+  largest = min(viewport_width, viewport_height)
+  for item in items:
+    pixels = int(math.ceil(size * item.placement[2]))
+    square = None
+    if textures.Available() and 0 < pixels <= min(largest, textures.size):
+      key = (item.rtime, item.unrender_time, tuple(item.main_color),
+             tuple(item.tip_color), viewport_width, viewport_height, pixels)
+      square = textures.Square(item.picture, key, keep)
+    if square is None:
+      uncached.append(item)
+    else:
+      keep.add(square)
+      quads.append((item.placement, square))
+  if quads:
+    gl_state.UseProgram(0)
+    gl_state.SetBlend((GL_ONE, GL_ONE_MINUS_SRC_ALPHA))
+    gl_state.Enable(GL_TEXTURE_2D)
+    gl_state.BindTexture(GL_TEXTURE_2D, textures.texture)
+    glColor(1, 1, 1, 1)
+    atlas = float(textures.size)
+    glBegin(GL_QUADS)
+    for (x, y, scale), (u, v, pixels) in quads:
+      for cx, cy in (0, 0), (1, 0), (1, 1), (0, 1):
+        glTexCoord2d((u + cx * pixels) / atlas, (v + cy * pixels) / atlas)
+        glVertex2d(x + cx * scale, y + cy * scale)
+    glEnd()
+    gl_state.Disable(GL_TEXTURE_2D)
+  if uncached:
+    RenderBatch(uncached, viewport_width, viewport_height, size)
+
+
+class ZipSource(object):
+  def __init__(self, path):
+    self.zip = zipfile.ZipFile(path, 'r')
+    self.words = self.zip.namelist()
+    self.word_set = set(self.words)
+
+  def __contains__(self, word):
+    return word in self.word_set
+
+  # Returns the same as Pack.Read. There is only one level in a zip.
+  def Read(self, word):
+    raw_data = self.zip.read(word)
+    points = (ctypes.c_float * (len(raw_data) / 4)).from_buffer_copy(raw_data)
+    return [(picture_pack.KIND_POINTS, points)]
+
+
+# The default size of the geometry cache.
+CACHE_BYTES = 32 << 20
+
+# How many completions of the typed word to prefetch.
+PREFETCH_WORDS = 4
+
+# How many threads load pictures for LoadWordPicture.
+LOADER_THREADS = 2
+
+
+# Decodes the geometry of the words the player is likely to type next,
+# on a background thread, so that they are in the cache by the time
+# Return is pressed. Only the latest request counts: the words of an
+# earlier prefix that are not done yet are dropped.
+class Prefetcher(object):
+  def __init__(self, loader):
+    self.loader = loader
+    self.condition = threading.Condition()
+    self.words = []
+    self.thread = threading.Thread(target=self.Run, name='prefetcher')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def Request(self, words):
+    with self.condition:
+      self.words = list(words)
+      self.condition.notify()
+
+  def Run(self):
+    while True:
+      with self.condition:
+        while not self.words:
+          self.condition.wait()
+        word = self.words.pop(0)
+      self.loader.Warm(word)
+
+
+class WordPictureLoader(object):
+  # Uses the memory mapped pack if there is one, the zip file otherwise.
+  #
+  # The geometry of the recently used words is kept, up to cache_bytes
+  # in total, and the least recently used is dropped first. A word that
+  # is still on the screen is never loaded twice, even if it was
+  # dropped from the cache. Prefetch fills the cache in the background
+  # while the player types, and LoadWordPicture loads a picture without
+  # waiting for it.
+  #
+  # Words that are not drawn are shown as the closest word that is (see
+  # word_index.py), or a random one if none is close.
+  def __init__(self, pack_path='pictures.pack', zip_path='pictures_vbuf.zip',
+               cache_bytes=CACHE_BYTES):
+    self.pack_path = pack_path
+    self.zip_path = zip_path
+    self.source = self.OpenSource()
+    # The zip module is not thread-safe, so every thread opens its own
+    # source (see Source).
+    self.local = threading.local()
+    self.local.source = self.source
+    self.pool = None
+    self.all_words = self.source.words
+    self.index = word_index.WordIndex(self.all_words)
+    self.cache_bytes = cache_bytes
+    # word -> (geometry, its size when it was last used)
+    self.cache = collections.OrderedDict()
+    self.cached_bytes = 0
+    self.live = weakref.WeakValueDictionary()
+    # Guards the cache, which the prefetcher also fills.
+    self.lock = threading.Lock()
+    self.prefetcher = None
+    # Whether WordPictureForWord found the geometry ready, and how many
+    # words the prefetcher decoded.
+    self.hits = self.misses = self.prefetched = 0
     print len(self.all_words), 'pictures loaded.'
 
+  def OpenSource(self):
+    if os.path.exists(self.pack_path):
+      return picture_pack.Pack(self.pack_path)
+    return ZipSource(self.zip_path)
+
+  # Returns the source of the current thread.
+  def Source(self):
+    source = getattr(self.local, 'source', None)
+    if source is None:
+      source = self.local.source = self.OpenSource()
+    return source
+
+  # Returns the geometry of a word if it is loaded, or None. Call with
+  # the lock held.
+  def _Take(self, word):
+    if word in self.cache:
+      geometry, size = self.cache.pop(word)
+      self.cached_bytes -= size
+      return geometry
+    return self.live.get(word)
+
+  # Puts the geometry of a word in the cache as the most recently used,
+  # and returns it. If another thread loaded the word in the meantime,
+  # that one is kept and returned instead. Call with the lock held.
+  def _Put(self, word, geometry):
+    if word in self.cache:
+      geometry, size = self.cache.pop(word)
+      self.cached_bytes -= size
+    geometry = self.live.setdefault(word, geometry)
+    # The size changes when another level of detail is expanded.
+    size = geometry.Bytes()
+    self.cache[word] = geometry, size
+    self.cached_bytes += size
+    while self.cached_bytes > self.cache_bytes and len(self.cache) > 1:
+      _, (_, size) = self.cache.popitem(last=False)
+      self.cached_bytes -= size
+    return geometry
+
+  # Returns the geometry of a word if it is loaded, or None, and counts
+  # the hits and misses.
+  def CachedGeometry(self, word):
+    with self.lock:
+      geometry = self._Take(word)
+      if geometry is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+      return self._Put(word, geometry)
+
+  # Loads the geometry of a word. Can be called on any thread.
+  def LoadGeometry(self, word):
+    geometry = WordGeometry(self.Source().Read(word))
+    with self.lock:
+      return self._Put(word, geometry)
+
+  def Geometry(self, word):
+    return self.CachedGeometry(word) or self.LoadGeometry(word)
+
+  # Loads a word into the cache, if it is not there yet. Called on the
+  # prefetcher thread.
+  def Warm(self, word):
+    with self.lock:
+      if word in self.cache or word in self.live:
+        return
+    self.LoadGeometry(word)
+    with self.lock:
+      self.prefetched += 1
+
+  # Starts loading the words the player may be typing, given what has
+  # been typed so far. The words of an earlier prefix that are not
+  # loaded yet are dropped, all of them if nothing is typed.
+  def Prefetch(self, prefix):
+    if not prefix:
+      if self.prefetcher is not None:
+        self.prefetcher.Request([])
+      return
+    words = self.index.Completions(prefix, PREFETCH_WORDS)
+    found = self.index.Find(prefix)
+    if found is not None and found not in words:
+      words.insert(0, found)
+    if self.prefetcher is None:
+      self.prefetcher = Prefetcher(self)
+    self.prefetcher.Request(words)
+
+  def Stats(self):
+    capacity = sum(arena.capacity * arena.vertex_bytes
+                   for arena in Arena.arenas.itervalues())
+    return ('%d hits, %d misses, %d prefetched, '
+            '%.1f of %.1fMB used on the GPU.' % (
+                self.hits, self.misses, self.prefetched,
+                LineBuffers.gpu_bytes / 1e6, capacity / 1e6))
+
+  def FindWord(self, word):
+    found = self.index.Find(word)
+    if found is None:
+      found = random.choice(self.all_words)
+    return found
+
   def WordPictureForWord(self, word):
-    if word not in self.all_words:
-      word = random.choice(self.all_words)
-    raw_data = self.source.read(word)
-    return WordPicture(raw_data)
+    return WordPicture(self.Geometry(self.FindWord(word)))
+
+  # Same as WordPictureForWord, but does not wait for the picture to
+  # load. See WordPicture.Ready.
+  def LoadWordPicture(self, word):
+    word = self.FindWord(word)
+    geometry = self.CachedGeometry(word)
+    if geometry is not None:
+      return WordPicture(geometry)
+    if self.pool is None:
+      self.pool = multiprocessing.pool.ThreadPool(LOADER_THREADS)
+    return WordPicture(None, self.pool.apply_async(self.LoadGeometry, (word,)))
 
 
 
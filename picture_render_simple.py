@@ -1,51 +1,173 @@
+import bisect
+import collections
 import ctypes
-import pictures_light as pictures
 import random
+import gl_state
+import stroke_store
 from OpenGL.GL import *
 
+# The strokes are only read from here when a word is first drawn.
+pictures = stroke_store.StrokeStore(['pictures_light.py'])
+
 
 class Shaders(object):
   @classmethod
   def Setup(self):
     pass
 
+
+# The segments of a picture, in vertex arrays for plain OpenGL 1.1.
+# The segments are bucketed by line width, rounded to whole pixels like
+# GL does for lines that are not smoothed, so each bucket is one draw.
+#
+# Each segment appears when the animation reaches a point: while
+# drawing, the one where it ends, while erasing, the one where it
+# starts. Every bucket is sorted by both, so the segments to draw are
+# always the first count in one of the orders, and the count can be
+# found with a binary search.
+class LineArrays(object):
+  def __init__(self, picture):
+    max_time = float(picture[-1][-1].time)
+    segments = {}
+    for stroke in picture:
+      time, x, y, pressure = stroke.Columns()
+      x = [v / 500.0 for v in x]
+      y = [1 - v / 500.0 for v in y]
+      # Like the original loop, each segment skips a point, and takes
+      # its width from the point it skips.
+      for i in xrange(len(time) - 2):
+        width = max(1, int(pressure[i + 1] * 0.01 + 0.5))
+        segments.setdefault(width, []).append((
+            time[i + 2] / max_time, time[i] / max_time,
+            x[i], y[i], x[i + 2], y[i + 2]))
+    # (width, drawing gates, drawing vertices, erasing gates, erasing
+    # vertices) for each bucket. The erasing gates are negated, to keep
+    # them ascending.
+    self.buckets = []
+    for width, bucket in sorted(segments.iteritems()):
+      bucket.sort()
+      drawing = [(end, x0, y0, x1, y1) for end, start, x0, y0, x1, y1 in bucket]
+      bucket.sort(key=lambda segment: -segment[1])
+      # Erasing goes through the strokes backwards.
+      erasing = [(-start, x1, y1, x0, y0)
+                 for end, start, x0, y0, x1, y1 in bucket]
+      self.buckets.append((width,) + self._Arrays(drawing) +
+                          self._Arrays(erasing))
+
+  # Returns the gates and a vertex array for a list of segments.
+  @staticmethod
+  def _Arrays(segments):
+    gates = [segment[0] for segment in segments]
+    vertices = (ctypes.c_double * (4 * len(segments)))()
+    for i, segment in enumerate(segments):
+      vertices[4 * i:4 * i + 4] = segment[1:]
+    return gates, vertices
+
+  # Draws the segments that have ended by rtime, or if erased_time is
+  # given, the ones that start after it.
+  def Render(self, rtime, erased_time=None):
+    glEnableClientState(GL_VERTEX_ARRAY)
+    for width, gates, vertices, erase_gates, erase_vertices in self.buckets:
+      if erased_time is not None:
+        count = bisect.bisect_right(erase_gates, -erased_time)
+        vertices = erase_vertices
+      else:
+        count = bisect.bisect_right(gates, rtime)
+      if count:
+        gl_state.LineWidth(width)
+        glVertexPointer(2, GL_DOUBLE, 0, vertices)
+        glDrawArrays(GL_LINES, 0, 2 * count)
+    glDisableClientState(GL_VERTEX_ARRAY)
+
+
 class WordPicture(object):
-  def __init__(self, word):
+  def __init__(self, word, lines):
     self.word = word
+    self.lines = lines
 
   @classmethod
   def RenderSetup(cls, main_color, tip_color, viewport_width, viewport_height):
     WordPicture.main_color = main_color
     WordPicture.tip_color = tip_color
 
-  def Render(self, rtime):
-    picture = pictures.words[self.word]
-    max_time = float(picture[-1][-1].time)
+  def Ready(self):
+    return True
+
+  # Like the shaders, the picture is unrendered from the start once it
+  # is drawn, but without the fade.
+  def Render(self, rtime, unrender_time=-10, size=None):
     glColor(*WordPicture.main_color)
-    erasing = WordPicture.tip_color == (0, 0, 0, 0)
-    for strip in picture:
-      if len(strip) < 2: continue
-      if erasing:
-        strip = list(reversed(strip))
-      oop = strip[0]
-      op = strip[1]
-      for p in strip[2:]:
-        if erasing and (1 - rtime) > p.time / max_time:
-          break
-        if not erasing and rtime < p.time / max_time:
-          break
-        glLineWidth(op.pressure * 0.01)
-        glBegin(GL_LINES)
-        glVertex2d(oop.x / 500.0, 1 - oop.y / 500.0)
-        glVertex2d(p.x / 500.0, 1 - p.y / 500.0)
-        glEnd()
-        oop = op
-        op = p
+    if WordPicture.tip_color == (0, 0, 0, 0):
+      self.lines.Render(rtime, 1 - rtime)
+    elif rtime >= 1 and unrender_time > 0:
+      self.lines.Render(rtime, unrender_time)
+    else:
+      self.lines.Render(rtime)
     glColor(1, 1, 1, 1)
 
 
+# Same as in picture_render, but just draws them one by one.
+def RenderMany(pictures, rtime, unrender_time=-10, size=None,
+               placements=None):
+  if placements is None:
+    placements = [None] * len(pictures)
+  for picture, placement in zip(pictures, placements):
+    glPushMatrix()
+    if placement is not None:
+      x, y, scale = placement
+      glTranslate(x, y, 0)
+      glScale(scale, scale, 1.0)
+    picture.Render(rtime, unrender_time, size)
+    glPopMatrix()
+
+
+BatchItem = collections.namedtuple(
+    'BatchItem',
+    'picture placement rtime unrender_time main_color tip_color')
+
+
+# Same as in picture_render, but just draws them one by one.
+def RenderBatch(items, viewport_width, viewport_height, size=None):
+  for item in items:
+    item.picture.RenderSetup(item.main_color, item.tip_color,
+                             viewport_width, viewport_height)
+    x, y, scale = item.placement
+    glPushMatrix()
+    glTranslate(x, y, 0)
+    glScale(scale, scale, 1.0)
+    item.picture.Render(item.rtime, item.unrender_time, size)
+    glPopMatrix()
+
+
+# Same as in picture_render, but without the texture atlas.
+def RenderCachedBatch(items, viewport_width, viewport_height, size):
+  RenderBatch(items, viewport_width, viewport_height, size)
+
+
+class _Textures(object):
+  def Stats(self):
+    return 'not used.'
+
+
+textures = _Textures()
+
+
 class WordPictureLoader(object):
+  def __init__(self):
+    self.lines = {}
+
+  # The strokes are read quickly enough, so there is nothing to do.
+  def Prefetch(self, prefix):
+    pass
+
+  def Stats(self):
+    return '%d pictures built.' % len(self.lines)
+
   def WordPictureForWord(self, word):
-    if word not in pictures.words:
-      word = random.choice(pictures.words.keys())
-    return WordPicture(word)
+    if word not in pictures:
+      word = random.choice(pictures.words)
+    if word not in self.lines:
+      self.lines[word] = LineArrays(pictures[word])
+    return WordPicture(word, self.lines[word])
+
+  LoadWordPicture = WordPictureForWord
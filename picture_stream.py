@@ -0,0 +1,251 @@
+import collections
+import hashlib
+import re
+
+# Reads the pictures.py files written by tools/drawer.html one word at
+# a time. The files are just a big dict literal:
+#
+#   words = {
+#     'candy': [
+#       [P(0,203,101,47), P(68,203,103,325), ...],
+#       ...
+#     ],
+#     ...
+#   }
+#
+# but importing them builds the whole dict (and compiles the module),
+# which does not scale. Here we tokenize the file in fixed-size chunks
+# and only ever hold the strokes of the current word.
+#
+# The same goes for the drawer's other formats, so they can be built
+# without going through Python first: tools/pictures.js is the same
+# with "var pictures = {" and // comments, and the pictures.json
+# download has the points as arrays:
+#
+#   {
+#   "candy": [[[0,203,101,47],[68,203,103,325],...],...],
+#   ...
+#   }
+
+P = collections.namedtuple('P', 'time x y pressure')
+
+CHUNK_SIZE = 1 << 16
+
+# The line that opens the dict, e.g. "words = {", "var pictures = {"
+# or just "{". The dict may go on on the same line.
+_HEADER = re.compile(r'^\s*(?:(?:var\s+)?\w+\s*=\s*)?\{')
+
+_TOKEN = re.compile(r"""\s*(?:
+    (?P<string>'[^'\n]*'|"[^"\n]*")
+  | P\((?P<point>[^()]*)\)
+  | (?P<punct>[][{}:,])
+  | (?P<number>[-+.\d][-+.\w]*|NaN|null)
+  | (?P<comment>(?:\#|//)[^\n]*\n)
+  )""", re.VERBOSE)
+
+# What ScanWords looks at: the strings, the brackets and the comments,
+# which may have quotes or brackets in them. A string or comment that
+# is cut off by the end of a chunk is partial. Everything else is
+# skipped in one go, so that there is always a match.
+_SCAN = re.compile(r"""[^'"[\]{}\#/]*(?:
+    (?P<string>'[^'\n]*'|"[^"\n]*")
+  | (?P<open>[[{])
+  | (?P<close>[]}])
+  | (?P<comment>(?:\#|//)[^\n]*\n)
+  | (?P<partial>['"][^'"\n]*\Z|(?:\#|//)[^\n]*\Z|/\Z)
+  | (?P<other>/|\Z)
+  )""", re.VERBOSE)
+
+
+def _Field(text):
+  text = text.strip()
+  try:
+    return int(text)
+  except ValueError:
+    pass
+  try:
+    value = float(text)
+  except ValueError:
+    # Some of the drawings have broken values, like NaN. These used to
+    # be patched up with 'NaN = None' at the top of every file.
+    return None
+  if value != value:
+    return None
+  return value
+
+
+# Takes the fields of a point, from between the parentheses of P(...)
+# or the brackets of an array.
+def _Point(fields):
+  if len(fields) != 4:
+    raise ValueError('Bad point: P(%s)' % ','.join(fields))
+  return P(*[_Field(f) for f in fields])
+
+
+# Moves to just after the "{" that opens the dict. Returns False if
+# there is none, and raises ValueError if there is something else in
+# the file.
+def _SkipHeader(f):
+  offset = f.tell()
+  for line in iter(f.readline, ''):
+    m = _HEADER.match(line)
+    if m:
+      f.seek(offset + m.end())
+      return True
+    offset += len(line)
+  if offset:
+    f.seek(0)
+    if f.read().strip():
+      raise ValueError('%s: no dict of pictures found' % f.name)
+  return False
+
+
+# Tokenizes the rest of the file, starting at the current position.
+def _Tokens(f):
+  buf = ''
+  pos = 0
+  eof = False
+  while True:
+    m = _TOKEN.match(buf, pos)
+    if m is None or m.end() == len(buf) and not eof:
+      # The token may continue in the next chunk.
+      if eof:
+        if buf[pos:].strip():
+          raise ValueError('Unexpected input: %r' % buf[pos:pos + 40])
+        return
+      chunk = f.read(CHUNK_SIZE)
+      eof = not chunk
+      buf = buf[pos:] + chunk
+      pos = 0
+      continue
+    pos = m.end()
+    kind = m.lastgroup
+    if kind != 'comment':
+      yield kind, m.group(kind)
+
+
+def _Expect(tokens, kind, value=None):
+  try:
+    k, v = next(tokens)
+  except StopIteration:
+    raise ValueError('Unexpected end of input, expected %s' % (value or kind))
+  if k != kind or value is not None and v != value:
+    raise ValueError('Expected %s, got %r' % (value or kind, v))
+  return v
+
+
+# Reads the strokes of one word, after its name.
+def _ReadStrokes(path, word, tokens):
+  _Expect(tokens, 'punct', ':')
+  _Expect(tokens, 'punct', '[')
+  strokes = []
+  stroke = None
+  point = None  # The fields of an array point.
+  for kind, value in tokens:
+    if kind == 'number' and point is not None:
+      point.append(value)
+    elif value == ']' and point is not None:
+      stroke.append(_Point(point))
+      point = None
+    elif point is not None:
+      if value != ',':
+        raise ValueError('%s: unexpected %r in %r' % (path, value, word))
+    elif kind == 'point' and stroke is not None:
+      stroke.append(_Point(value.split(',')))
+    elif value == '[' and stroke is None:
+      stroke = []
+    elif value == '[':
+      point = []
+    elif value == ']' and stroke is not None:
+      strokes.append(stroke)
+      stroke = None
+    elif value == ']':
+      return strokes
+    elif value != ',':
+      raise ValueError('%s: unexpected %r in %r' % (path, value, word))
+  raise ValueError('%s: unexpected end of input in %r' % (path, word))
+
+
+# Yields (word, strokes) pairs in file order. The strokes are lists of
+# P tuples, same as in the imported module. Like ScanWords, raises
+# ValueError for a file that is not empty but has no words.
+def ReadWords(path):
+  with open(path, 'rb') as f:
+    if not _SkipHeader(f):
+      return
+    tokens = _Tokens(f)
+    word = None
+    for kind, value in tokens:
+      if value == ',':
+        continue
+      if value == '}':
+        if word is None:
+          raise ValueError('%s: no words in the dict' % path)
+        return
+      if kind != 'string':
+        raise ValueError('%s: expected a word, got %r' % (path, value))
+      word = value[1:-1]
+      yield word, _ReadStrokes(path, word, tokens)
+    raise ValueError('%s: unexpected end of input' % path)
+
+
+# Quickly finds where each word starts, without tokenizing the points.
+# Yields (word, offset, digest) triples, where the offset can be passed
+# to ReadWordAt and the digest is a SHA-1 of the word's source text, up
+# to the next word. Only the strings and brackets are looked at: the
+# words are the strings in the dict that are not inside a list, however
+# the lines go. Raises ValueError for a file that is not empty but has
+# no words.
+def ScanWords(path):
+  with open(path, 'rb') as f:
+    if not _SkipHeader(f):
+      return
+    offset = f.tell()  # of buf
+    buf = ''
+    eof = False
+    depth = 0
+    word = word_offset = None
+    while not eof:
+      chunk = f.read(CHUNK_SIZE)
+      eof = not chunk
+      buf += chunk
+      done = len(buf)
+      for m in _SCAN.finditer(buf):
+        kind = m.lastgroup
+        if kind == 'partial':
+          if not eof:
+            # Wait for the rest of it in the next chunk.
+            done = m.start(kind)
+            break
+        elif kind == 'open':
+          depth += 1
+        elif kind == 'close' and depth:
+          depth -= 1
+        elif kind == 'close' or kind == 'string' and not depth:
+          if word is not None:
+            digest.update(buf[digest_start:m.start(kind)])
+            yield word, word_offset, digest.hexdigest()
+            word = None
+          if kind == 'close':
+            if word_offset is None:
+              raise ValueError('%s: no words in the dict' % path)
+            return
+          word = m.group(kind)[1:-1]
+          word_offset = offset + m.start(kind)
+          digest = hashlib.sha1()
+          digest_start = m.start(kind)
+      if word is not None:
+        digest.update(buf[digest_start:done])
+        digest_start = 0
+      offset += done
+      buf = buf[done:]
+    raise ValueError('%s: unexpected end of input' % path)
+
+
+# Returns (word, strokes) for the word at an offset from ScanWords.
+def ReadWordAt(path, offset):
+  with open(path, 'rb') as f:
+    f.seek(offset)
+    tokens = _Tokens(f)
+    word = _Expect(tokens, 'string')[1:-1]
+    return word, _ReadStrokes(path, word, tokens)
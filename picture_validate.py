@@ -0,0 +1,158 @@
+import argparse
+import itertools
+import json
+import sys
+
+import numpy
+
+import picture_stream
+
+# Checks the drawings before they are encoded, instead of patching up
+# the sources by hand. Each picture is turned into one array and
+# checked with array operations. What can be repaired is repaired:
+#
+#   missing-value       A point has NaN or None for its time or position
+#                       (dropped), or for its pressure (interpolated).
+#   time-goes-back      The time decreases within a stroke (clamped).
+#   zero-length-stroke  A stroke does not go anywhere (dropped).
+#
+# The pictures that cannot be drawn are rejected:
+#
+#   empty               No strokes are left.
+#   zero-area           All points are on one horizontal or vertical
+#                       line, so the picture cannot be scaled to fit.
+#   zero-duration       All points have the same time, so the drawing
+#                       cannot be animated.
+#
+# Run it on its own for a JSON report of the whole corpus:
+#
+#   python picture_validate.py pictures_missing*.py > report.json
+
+# The pressure of a stroke with no pressure at all. This is the
+# pressure of full width (see GenerateVertexBuffer).
+DEFAULT_PRESSURE = 500
+
+_REJECTIONS = 'empty', 'zero-area', 'zero-duration'
+
+
+# Returns the points of a picture as an (n, 4) array, with NaN for the
+# missing values, and the length of each stroke.
+def _PictureArray(data):
+  lengths = [len(stroke) for stroke in data]
+  count = sum(lengths)
+  try:
+    points = numpy.fromiter(itertools.chain.from_iterable(
+        itertools.chain.from_iterable(data)), numpy.float64, 4 * count)
+  except TypeError:
+    # There is a None somewhere. This is much slower, but rare.
+    points = numpy.array(
+        [p for stroke in data for p in stroke], numpy.float64).ravel()
+  return points.reshape(-1, 4), lengths
+
+
+# Checks and repairs a picture (lists of P tuples, as from
+# picture_stream). Returns (strokes, problems), where strokes is the
+# repaired picture, or None if it was rejected. The strokes that need
+# no repair are returned as they are. Each problem is a dict with the
+# problem name (see above), the stroke number if it is about a stroke,
+# the number of points if it is about points, and what was done.
+def ValidatePicture(data):
+  all_points, lengths = _PictureArray(data)
+  ends = numpy.cumsum(lengths)
+  problems = []
+  strokes = []
+  for i, (stroke, points) in enumerate(
+      zip(data, numpy.split(all_points, ends[:-1]))):
+    repaired = False
+    missing = numpy.isnan(points[:, :3]).any(axis=1)
+    if missing.any():
+      problems.append({'problem': 'missing-value', 'stroke': i,
+                       'points': int(missing.sum()), 'action': 'dropped'})
+      points = points[~missing]
+      repaired = True
+    pressure = points[:, 3]
+    missing = numpy.isnan(pressure)
+    if missing.any():
+      problems.append({'problem': 'missing-value', 'stroke': i,
+                       'points': int(missing.sum()), 'action': 'interpolated'})
+      if missing.all():
+        pressure[:] = DEFAULT_PRESSURE
+      else:
+        index = numpy.arange(len(pressure))
+        pressure[missing] = numpy.interp(
+            index[missing], index[~missing], pressure[~missing])
+      repaired = True
+    time = points[:, 0]
+    backwards = time[1:] < time[:-1]
+    if backwards.any():
+      problems.append({'problem': 'time-goes-back', 'stroke': i,
+                       'points': int(backwards.sum()), 'action': 'clamped'})
+      numpy.maximum.accumulate(time, out=time)
+      repaired = True
+    if not (numpy.diff(points[:, 1:3], axis=0) != 0).any():
+      problems.append({'problem': 'zero-length-stroke', 'stroke': i,
+                       'points': len(points), 'action': 'dropped'})
+      continue
+    if repaired:
+      stroke = [picture_stream.P(*p) for p in points.tolist()]
+    strokes.append((stroke, points))
+
+  rejection = None
+  if not strokes:
+    rejection = 'empty'
+  else:
+    all_points = numpy.concatenate([points for stroke, points in strokes])
+    extent = (all_points[:, 1:3].max(axis=0) -
+              all_points[:, 1:3].min(axis=0))
+    duration = sum(points[-1, 0] - points[0, 0] for stroke, points in strokes)
+    if not extent.all():
+      rejection = 'zero-area'
+    elif not duration:
+      rejection = 'zero-duration'
+  if rejection:
+    problems.append({'problem': rejection, 'action': 'rejected'})
+    return None, problems
+  return [stroke for stroke, points in strokes], problems
+
+
+# Returns 'ok', 'repaired' or 'rejected' for a list of problems.
+def Status(problems):
+  if not problems:
+    return 'ok'
+  if problems[-1]['problem'] in _REJECTIONS:
+    return 'rejected'
+  return 'repaired'
+
+
+# Validates all the words in the sources. If a word appears more than
+# once, the last one wins, like in the build. Returns the report as a
+# dict, ready for JSON. Only the words with problems are listed.
+def ValidateCorpus(sources):
+  results = {}
+  for source in sources:
+    for word, data in picture_stream.ReadWords(source):
+      strokes, problems = ValidatePicture(data)
+      results[word] = source, problems
+  counts = dict.fromkeys(['ok', 'repaired', 'rejected'], 0)
+  words = {}
+  for word, (source, problems) in results.iteritems():
+    status = Status(problems)
+    counts[status] += 1
+    if problems:
+      words[word] = {'source': source, 'status': status,
+                     'problems': problems}
+  return {'summary': counts, 'words': words}
+
+
+def main(argv):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('sources', nargs='+')
+  args = parser.parse_args(argv[1:])
+  report = ValidateCorpus(args.sources)
+  json.dump(report, sys.stdout, indent=1, sort_keys=True)
+  print
+  return 1 if report['summary']['rejected'] else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
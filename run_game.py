@@ -1,5 +1,6 @@
 import ctypes
 import contextlib
+import gl_state
 import math
 import os
 import picture_render
@@ -35,18 +36,20 @@ def Quad(width, height):
 
 @contextlib.contextmanager
 def Texture(tex):
-  glEnable(GL_TEXTURE_2D)
-  glBindTexture(GL_TEXTURE_2D, tex)
+  gl_state.Enable(GL_TEXTURE_2D)
+  gl_state.BindTexture(GL_TEXTURE_2D, tex)
   yield
-  glDisable(GL_TEXTURE_2D)
+  gl_state.Disable(GL_TEXTURE_2D)
 
 
 @contextlib.contextmanager
 def Blending(src, dst):
-  glEnable(GL_BLEND)
-  glBlendFunc(src, dst)
+  # Puts back the blending from before, so the pictures that come next
+  # find it as they left it.
+  previous = gl_state.Blend()
+  gl_state.SetBlend((src, dst))
   yield
-  glDisable(GL_BLEND)
+  gl_state.SetBlend(previous)
 
 
 @contextlib.contextmanager
@@ -76,7 +79,7 @@ class Font(object):
       tex = glGenTextures(1)
       width = surface.get_width()
       height = surface.get_height()
-      glBindTexture(GL_TEXTURE_2D, tex)
+      gl_state.BindTexture(GL_TEXTURE_2D, tex)
       glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
       glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
       glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP)
@@ -86,7 +89,7 @@ class Font(object):
         self.DropCache()
       self.cache[text] = width, height, tex
     width, height, tex = self.cache[text]
-    glUseProgram(0)
+    gl_state.UseProgram(0)
     with Transform():
       glTranslate(x, y, 0)
       with Texture(tex):
@@ -98,7 +101,7 @@ class Font(object):
 
   def DropCache(self):
     for w, h, tex in self.cache.values():
-      glDeleteTextures(tex)
+      gl_state.DeleteTexture(tex)
     self.cache = {}
 
 
@@ -238,6 +241,9 @@ class Game(object):
         if e.type == pygame.KEYDOWN:
           self.HandleKey(e.key)
         if e.type == pygame.QUIT or e.type == pygame.KEYDOWN and e.key == pygame.K_ESCAPE:
+          print 'Pictures:', self.wpl.Stats()
+          print 'GL state:', gl_state.Stats()
+          print 'Textures:', picture_render.textures.Stats()
           pygame.quit()
           sys.exit(0)
 
@@ -257,6 +263,10 @@ class Game(object):
         glTranslate(0, 100, 0)
         glScale(300, 300, 1.0)
         for p in self.pictures[:]:
+          if not p.Ready():
+            # The animation starts when the picture is loaded.
+            p.start = self.time
+            continue
           with Transform():
             t = self.time - p.start
             s = 1.0 + t * 0.1
@@ -265,24 +275,26 @@ class Game(object):
             if t < 3.5:
               p.RenderSetup(p.primary, p.secondary, WIDTH, HEIGHT)
               if p.accepted:
-                p.Render(t, t - 2.5)
+                p.Render(t, t - 2.5, size=300 * s)
               else:
-                p.Render(t, t - 1.4)
+                p.Render(t, t - 1.4, size=300 * s)
             else:
               self.pictures.remove(p)
 
         if self.victory:
-          for p in self.victory_pictures.values():
-            with Transform():
-              glTranslate(-0.5 + p.x, -0.5 + p.y, 0)
-              glScale(p.scale, p.scale, 1.0)
-              p.RenderSetup((0, 0, 0, 1), (0, 0, 0, 1), WIDTH, HEIGHT)
-              p.Render(2)
+          # They are fully drawn and stay that way, so after the first
+          # frame they are quads from the texture atlas.
+          picture_render.RenderCachedBatch(
+              [picture_render.BatchItem(p, (-0.5 + p.x, -0.5 + p.y, p.scale),
+                                        2, -10, (0, 0, 0, 1), (0, 0, 0, 1))
+               for p in self.victory_pictures.values() if p.Ready()],
+              WIDTH, HEIGHT, size=300)
 
       self.font.Render(0, -200, self.word.upper())
       if self.misses >= 3 + self.games_played:
         self.hint_font.Render(0, -260, self.rule.hint())
       pygame.display.flip()
+      gl_state.EndFrame()
 
   def HandleKey(self, key):
     if self.victory:
@@ -290,13 +302,15 @@ class Game(object):
       return
     if ord('a') <= key <= ord('z'):
       self.word += chr(key)
+      self.wpl.Prefetch(self.word)
     elif key == pygame.K_BACKSPACE:
       self.word = self.word[:-1]
+      self.wpl.Prefetch(self.word)
     elif key == pygame.K_RETURN and self.word:
       if self.rule.accepts(self.word):
         SOUNDS['accepted'].play()
         if self.word not in self.victory_pictures:
-          p = self.wpl.WordPictureForWord(self.word)
+          p = self.wpl.LoadWordPicture(self.word)
           self.score += 1
           self.victory_pictures[self.word] = p
           p.primary = 0.3, 2, 0.3, 1
@@ -307,7 +321,7 @@ class Game(object):
           p.secondary = 0, 0, 0, 0
         p.accepted = True
       else:
-        p = self.wpl.WordPictureForWord(self.word)
+        p = self.wpl.LoadWordPicture(self.word)
         SOUNDS['rejected'].play()
         p.accepted = False
         p.primary = 2, 0.3, 0.3, 1
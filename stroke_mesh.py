@@ -0,0 +1,125 @@
+import math
+
+import numpy
+
+# The line drawing shader fills a fat line around every segment, and
+# measures the distance to the segment in every fragment to cut out a
+# capsule. Most of those fragments are thrown away, and under a
+# software renderer the fill is what takes the time. This tessellates
+# the strokes ahead of time into one triangle strip per picture that
+# covers just the lines, so the fragment shader only has to color them
+# (see MESH_VERTEX_SHADER in picture_render.py).
+#
+# Each vertex is a point of a stroke (x, y, time, pressure) and an
+# extrusion: which way to move it on the screen, in line widths. The
+# width of a line is set on the screen, not in the picture, so the
+# vertex shader does the moving, with the width from the pressure.
+#
+# The strokes get round caps, and the joins get round outer corners,
+# with a vertex every JOIN_STEP radians, like the capsules that the
+# line drawing shader cuts out. A join that turns less than that is
+# mitered instead, which is less than 4% of the width off. The strokes
+# are connected by degenerate triangles.
+
+JOIN_STEP = math.pi / 6
+
+# The vertex steps of a quarter circle of a cap.
+CAP_STEPS = 3
+
+# Floats per vertex: x, y, time, pressure, extrusion x, extrusion y.
+VERTEX_FLOATS = 6
+
+
+def _Rotate(v, angle):
+  c = math.cos(angle)
+  s = math.sin(angle)
+  return v[0] * c - v[1] * s, v[0] * s + v[1] * c
+
+
+# Returns the triangle strip of a stroke, a list of vertex tuples. The
+# points are (x, y, time, pressure), with no two in a row in the same
+# place.
+def TessellateStroke(points):
+  strip = []
+
+  def Add(point, extrusion):
+    strip.append(tuple(point) + extrusion)
+
+  directions = []
+  for a, b in zip(points, points[1:]):
+    dx = b[0] - a[0]
+    dy = b[1] - a[1]
+    length = math.hypot(dx, dy)
+    directions.append((dx / length, dy / length))
+  if not directions:
+    # A dot is two caps back to back.
+    directions.append((1.0, 0.0))
+  # The vertices go in pairs across the stroke, the left one first.
+  # The start cap goes from the back of the first point to the sides.
+  d = directions[0]
+  back = -d[0], -d[1]
+  Add(points[0], back)
+  for k in xrange(1, CAP_STEPS + 1):
+    angle = k * math.pi / 2 / CAP_STEPS
+    Add(points[0], _Rotate(back, -angle))
+    Add(points[0], _Rotate(back, angle))
+  for point, d0, d1 in zip(points[1:], directions, directions[1:]):
+    n0 = -d0[1], d0[0]
+    n1 = -d1[1], d1[0]
+    turn = math.atan2(d0[0] * d1[1] - d0[1] * d1[0],
+                      d0[0] * d1[0] + d0[1] * d1[1])
+    if abs(turn) < JOIN_STEP:
+      cos = 1 + n0[0] * n1[0] + n0[1] * n1[1]
+      miter = (n0[0] + n1[0]) / cos, (n0[1] + n1[1]) / cos
+      Add(point, miter)
+      Add(point, (-miter[0], -miter[1]))
+      continue
+    # The two segments overlap on the inside of the turn. The outside is
+    # a fan around the point: on the right for a left turn, on the left
+    # for a right turn.
+    Add(point, n0)
+    Add(point, (-n0[0], -n0[1]))
+    steps = int(math.ceil(abs(turn) / JOIN_STEP))
+    for k in xrange(1, steps):
+      angle = turn * k / steps
+      if turn > 0:
+        Add(point, (0.0, 0.0))
+        Add(point, _Rotate((-n0[0], -n0[1]), angle))
+      else:
+        Add(point, _Rotate(n0, angle))
+        Add(point, (0.0, 0.0))
+    Add(point, n1)
+    Add(point, (-n1[0], -n1[1]))
+  # The end cap goes from the sides of the last point to its front.
+  d = directions[-1]
+  n = -d[1], d[0]
+  if len(points) > 1:
+    Add(points[-1], n)
+    Add(points[-1], (-n[0], -n[1]))
+  for k in xrange(1, CAP_STEPS):
+    angle = k * math.pi / 2 / CAP_STEPS
+    Add(points[-1], _Rotate(n, -angle))
+    Add(points[-1], _Rotate((-n[0], -n[1]), angle))
+  Add(points[-1], d)
+  return strip
+
+
+# Returns the triangle strip of a picture as a float32 array of shape
+# (N, VERTEX_FLOATS). Takes the points from GenerateVertexArray, and
+# the number of points of each stroke in them. (Each stroke there has
+# an extra zero-pressure point at both ends, which is not drawn.)
+def TessellatePicture(vertices, lengths):
+  strip = []
+  start = 0
+  for length in lengths:
+    points = []
+    for point in vertices[start + 1:start + 1 + length].tolist():
+      if not points or point[:2] != points[-1][:2]:
+        points.append(point)
+    start += length + 2
+    stroke = TessellateStroke(points)
+    if strip:
+      strip.append(strip[-1])
+      strip.append(stroke[0])
+    strip.extend(stroke)
+  return numpy.array(strip, numpy.float32).reshape(-1, VERTEX_FLOATS)
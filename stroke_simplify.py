@@ -0,0 +1,106 @@
+import itertools
+
+import numpy
+
+# The drawer records a point on every mouse move, so the strokes have
+# lots of nearly collinear points, and each of them becomes a segment
+# for the fragment shader to fill. This drops the points that can be
+# interpolated from their neighbours, Ramer-Douglas-Peucker style.
+#
+# A point can only be dropped if the simplified stroke passes within
+# epsilon pixels of it, and the pressure and time interpolated along
+# the simplified segment are within tolerance too. So the line width
+# and the drawing animation do not change visibly either. Points are
+# only ever dropped, never moved, so time stays monotone.
+
+EPSILON = 0.5  # pixels
+PRESSURE_TOLERANCE = 20  # out of 1000
+TIME_TOLERANCE = 30  # milliseconds
+
+
+# Returns (errors, distances) for the points between a and b, relative
+# to the segment from a to b. An error above 1 means the point has to
+# stay.
+def _Errors(points, a, b, epsilon, pressure_tolerance, time_tolerance):
+  ta, xa, ya, pa = points[a]
+  tb, xb, yb, pb = points[b]
+  t, x, y, p = points[a + 1:b].T
+  dx = xb - xa
+  dy = yb - ya
+  length2 = dx * dx + dy * dy
+  if length2 > 0:
+    u = numpy.clip(((x - xa) * dx + (y - ya) * dy) / length2, 0, 1)
+  elif tb != ta:
+    u = (t - ta) / (tb - ta)
+  else:
+    u = numpy.zeros(len(t))
+  distances = numpy.hypot(x - xa - u * dx, y - ya - u * dy)
+  errors = numpy.maximum(distances / epsilon, numpy.maximum(
+      numpy.abs(p - pa - u * (pb - pa)) / pressure_tolerance,
+      numpy.abs(t - ta - u * (tb - ta)) / time_tolerance))
+  return errors, distances
+
+
+# Takes an (n, 4) array of (time, x, y, pressure) and a boolean array
+# of the points that must be kept. Marks the other points that need to
+# stay in keep, and returns the largest distance of a dropped point
+# from the simplified stroke.
+def SimplifyStroke(points, keep, epsilon=EPSILON,
+                   pressure_tolerance=PRESSURE_TOLERANCE,
+                   time_tolerance=TIME_TOLERANCE):
+  keep[0] = keep[-1] = True
+  kept = numpy.flatnonzero(keep)
+  stack = zip(kept[:-1], kept[1:])
+  deviation = 0.0
+  while stack:
+    a, b = stack.pop()
+    if b - a < 2:
+      continue
+    errors, distances = _Errors(
+        points, a, b, epsilon, pressure_tolerance, time_tolerance)
+    i = errors.argmax()
+    if errors[i] > 1:
+      i += a + 1
+      keep[i] = True
+      stack.append((a, i))
+      stack.append((i, b))
+    else:
+      deviation = max(deviation, distances.max())
+  return deviation
+
+
+# Simplifies all the strokes of a picture (lists of P tuples, as from
+# picture_stream). The points that set the bounding box are always
+# kept, so the picture is normalized the same way. Returns the new
+# strokes and a report of (points before, points after, largest
+# deviation in pixels).
+def SimplifyPicture(data, epsilon=EPSILON,
+                    pressure_tolerance=PRESSURE_TOLERANCE,
+                    time_tolerance=TIME_TOLERANCE):
+  strokes = []
+  for stroke in data:
+    n = len(stroke)
+    while n and stroke[n - 1].time == None:
+      n -= 1
+    if n:
+      strokes.append(stroke[:n])
+  if not strokes:
+    return data, (0, 0, 0.0)
+  arrays = [
+    numpy.fromiter(itertools.chain.from_iterable(stroke), numpy.float64,
+                   4 * len(stroke)).reshape(-1, 4)
+    for stroke in strokes]
+  all_points = numpy.concatenate(arrays)
+  low = all_points[:, 1:3].min(axis=0)
+  high = all_points[:, 1:3].max(axis=0)
+  result = []
+  before = after = 0
+  deviation = 0.0
+  for stroke, points in zip(strokes, arrays):
+    keep = ((points[:, 1:3] == low) | (points[:, 1:3] == high)).any(axis=1)
+    deviation = max(deviation, SimplifyStroke(
+        points, keep, epsilon, pressure_tolerance, time_tolerance))
+    result.append([stroke[i] for i in numpy.flatnonzero(keep)])
+    before += len(points)
+    after += len(result[-1])
+  return result, (before, after, deviation)
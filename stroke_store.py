@@ -0,0 +1,119 @@
+import array
+
+import picture_stream
+
+# Keeps the strokes of the pictures in flat arrays, one per field,
+# instead of a P namedtuple per point. The words are found by a quick
+# scan of the sources (see picture_stream.ScanWords), and each one is
+# only parsed when it is first used.
+#
+# The arrays hold the points of all the loaded words back to back.
+# stroke_starts has the index of the first point of every stroke, plus
+# one past the last point, and index maps each loaded word to the range
+# of its strokes. Reading a picture gives lightweight views that act
+# like the lists of P tuples:
+#
+#   picture = store['candy']
+#   picture[0][1].x, picture[-1][-1].time, len(picture[0])
+
+
+class StrokeView(object):
+  __slots__ = 'store', 'start', 'end'
+
+  def __init__(self, store, start, end):
+    self.store = store
+    self.start = start
+    self.end = end
+
+  def __len__(self):
+    return self.end - self.start
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [self[j] for j in xrange(*i.indices(len(self)))]
+    if i < 0:
+      i += len(self)
+    if not 0 <= i < len(self):
+      raise IndexError(i)
+    i += self.start
+    store = self.store
+    return picture_stream.P(*[
+        None if value != value else value for value in (
+            store.time[i], store.x[i], store.y[i], store.pressure[i])])
+
+  def __iter__(self):
+    for i in xrange(len(self)):
+      yield self[i]
+
+  # Returns the (time, x, y, pressure) arrays of the stroke.
+  def Columns(self):
+    store = self.store
+    return [column[self.start:self.end] for column in (
+        store.time, store.x, store.y, store.pressure)]
+
+
+class PictureView(object):
+  __slots__ = 'store', 'first', 'count'
+
+  def __init__(self, store, first, count):
+    self.store = store
+    self.first = first
+    self.count = count
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [self[j] for j in xrange(*i.indices(len(self)))]
+    if i < 0:
+      i += self.count
+    if not 0 <= i < self.count:
+      raise IndexError(i)
+    i += self.first
+    starts = self.store.stroke_starts
+    return StrokeView(self.store, starts[i], starts[i + 1])
+
+  def __iter__(self):
+    for i in xrange(self.count):
+      yield self[i]
+
+
+class StrokeStore(object):
+  # Takes a list of picture sources, in any format picture_stream reads.
+  # If a word appears more than once, the last one wins.
+  def __init__(self, sources):
+    self.sources = {}
+    for source in sources:
+      for word, offset, digest in picture_stream.ScanWords(source):
+        self.sources[word] = source, offset
+    self.words = sorted(self.sources)
+    # Missing values are stored as NaN, and read back as None.
+    self.time = array.array('f')
+    self.x = array.array('f')
+    self.y = array.array('f')
+    self.pressure = array.array('f')
+    self.stroke_starts = array.array('l', [0])
+    self.index = {}
+
+  def __contains__(self, word):
+    return word in self.sources
+
+  def Load(self, word):
+    if word in self.index:
+      return
+    source, offset = self.sources[word]
+    _, strokes = picture_stream.ReadWordAt(source, offset)
+    nan = float('nan')
+    self.index[word] = len(self.stroke_starts) - 1, len(strokes)
+    for stroke in strokes:
+      for field, column in zip(zip(*stroke), (
+          self.time, self.x, self.y, self.pressure)):
+        column.extend(nan if value is None else value for value in field)
+      self.stroke_starts.append(len(self.time))
+
+  # Returns a PictureView of the strokes of a word.
+  def __getitem__(self, word):
+    self.Load(word)
+    first, count = self.index[word]
+    return PictureView(self, first, count)
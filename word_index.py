@@ -0,0 +1,168 @@
+import bisect
+import collections
+import heapq
+import random
+import sys
+import time
+
+# Finds the picture for a typed word, even if it is not drawn exactly.
+# First the word itself is looked up, then its stem, so that "boxes"
+# shows the box. Then the closest word by edit distance, so that
+# "elefant" shows the elephant.
+#
+# The fuzzy search uses an index of the trigrams of the words, split by
+# word length. Only the words of about the right length that share
+# enough trigrams with the typed word are compared with it, so a search
+# takes well under a millisecond even with 100,000 words.
+
+
+# Returns the word without its plural or verb ending. This is just
+# enough English to match the nouns that are drawn, not a real stemmer.
+def Stem(word):
+  word = word.lower()
+  if len(word) > 4 and word.endswith('ies'):
+    return word[:-3] + 'y'
+  if len(word) > 4 and word.endswith('ves'):
+    return word[:-3] + 'f'
+  if word.endswith(('sses', 'xes', 'zes', 'ches', 'shes')):
+    return word[:-2]
+  if len(word) > 5 and word.endswith('ing'):
+    return word[:-3]
+  if len(word) > 4 and word.endswith('ed'):
+    return word[:-2]
+  if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+    return word[:-1]
+  return word
+
+
+def Trigrams(word):
+  word = '^%s$' % word
+  return set(word[i:i + 3] for i in xrange(len(word) - 2))
+
+
+# Returns the edit distance between a and b, or limit + 1 if it is
+# more than limit.
+def EditDistance(a, b, limit):
+  if abs(len(a) - len(b)) > limit:
+    return limit + 1
+  previous = range(len(b) + 1)
+  for i, ca in enumerate(a):
+    current = [i + 1]
+    for j, cb in enumerate(b):
+      current.append(min(previous[j + 1] + 1, current[j] + 1,
+                         previous[j] + (ca != cb)))
+    if min(current) > limit:
+      return limit + 1
+    previous = current
+  return previous[-1]
+
+
+# The number of typos to allow in a word.
+def MaxDistance(word):
+  if len(word) <= 3:
+    return 0
+  if len(word) <= 6:
+    return 1
+  return 2
+
+
+class WordIndex(object):
+  def __init__(self, words):
+    self.words = set(words)
+    self.sorted_words = sorted(self.words)
+    # stem -> the shortest word with it
+    self.stems = {}
+    for word in sorted(self.words, key=len, reverse=True):
+      self.stems[Stem(word)] = word
+    # (length, trigram) -> words
+    self.trigrams = collections.defaultdict(list)
+    for word in self.sorted_words:
+      for trigram in Trigrams(word):
+        self.trigrams[len(word), trigram].append(word)
+
+  def __contains__(self, word):
+    return word in self.words
+
+  # Returns the closest word by edit distance, or None if there is none
+  # within MaxDistance.
+  def Nearest(self, word):
+    limit = MaxDistance(word)
+    if not limit:
+      return None
+    trigrams = Trigrams(word)
+    shared = collections.defaultdict(int)
+    for length in xrange(len(word) - limit, len(word) + limit + 1):
+      for trigram in trigrams:
+        for candidate in self.trigrams.get((length, trigram), ()):
+          shared[candidate] += 1
+    # Each typo changes at most 3 trigrams, so the candidates that share
+    # more trigrams are tried first, and the search can stop when the
+    # rest cannot be closer than the best so far. Ties go to the one
+    # that shares more trigrams, then to the first alphabetically.
+    best = None
+    for count, candidate in sorted(
+        ((-count, candidate) for candidate, count in shared.iteritems())):
+      count = -count
+      bound = (len(trigrams) - count + 2) / 3
+      if bound > limit:
+        break
+      if best and (bound, -count) > best[:2]:
+        break
+      distance = EditDistance(word, candidate, limit)
+      if distance <= limit:
+        key = distance, -count, candidate
+        if best is None or key < best:
+          best = key
+          limit = distance
+    return best and best[2]
+
+  # Returns up to limit words that start with a prefix, shortest first.
+  def Completions(self, prefix, limit):
+    prefix = prefix.lower()
+    start = bisect.bisect_left(self.sorted_words, prefix)
+    end = bisect.bisect_left(self.sorted_words, prefix + '\xff', start)
+    return heapq.nsmallest(limit, self.sorted_words[start:end],
+                           key=lambda word: (len(word), word))
+
+  # Returns the word to show for a typed word, or None.
+  def Find(self, word):
+    word = word.lower()
+    if word in self.words:
+      return word
+    stem = Stem(word)
+    if stem in self.stems:
+      return self.stems[stem]
+    return self.Nearest(word) or self.Nearest(stem)
+
+
+# Times the lookups on a word list (one word per line), or on random
+# words if none is given.
+def Benchmark(path=None, count=1000):
+  if path:
+    with open(path) as f:
+      words = [line.strip().lower() for line in f if line.strip().isalpha()]
+  else:
+    rng = random.Random(0)
+    words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz')
+                     for _ in xrange(rng.randint(3, 12)))
+             for _ in xrange(100000)]
+  start = time.time()
+  index = WordIndex(words)
+  print '%d words indexed in %.2fs' % (len(index.words), time.time() - start)
+  rng = random.Random(1)
+  queries = []
+  for word in rng.sample(words, count):
+    i = rng.randrange(len(word))
+    queries.append(word[:i] + rng.choice('aeiou') + word[i + 1:])
+  for name, typed in [('exact', rng.sample(words, count)),
+                      ('plural', [word + 's' for word in queries]),
+                      ('typo', queries)]:
+    start = time.time()
+    found = sum(1 for word in typed if index.Find(word) is not None)
+    spent = time.time() - start
+    print '%-6s %4d of %d found, %.3fms per lookup' % (
+        name, found, len(typed), 1000 * spent / len(typed))
+
+
+if __name__ == '__main__':
+  Benchmark(*sys.argv[1:])